@@ -0,0 +1,66 @@
+from src.bayesian_op import blur, optimize_map_sar_gd, loss_map_sar, synth_pan
+from scipy.ndimage import gaussian_filter, laplace
+import argparse
+import time
+import numpy as np
+
+LAMBDA = [0.0842, 0.5375, 0.3784, 0.0000] # Landsat 8 weights, as in main.py
+
+def synthetic_crop(size, seed=0):
+    """Synthetic (MS, PAN) crop: a textured PAN and MS bands that are blurred, scaled copies of it plus noise."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    pan = 8000 + 3000 * np.sin(xx / 17.0) * np.cos(yy / 23.0) + rng.normal(0, 300, (size, size))
+    Y = np.stack([gaussian_filter(pan, 2.0) * c + rng.normal(0, 100, (size, size)) for c in (0.6, 0.8, 1.0, 1.2)])
+    return Y.astype(np.float32), pan.astype(np.float32)
+
+def spatial_gd(Y, x, lambdas, alpha=0.001, beta=1.0, sigma_blur=1.2, lr=0.05, max_iter=50):
+    """
+    The original spatial-domain gradient descent of MAP-SAR (filters on every band at every iteration, PAN residual
+    recomputed per band), kept as the baseline of the timings. Its iterates are those of solver='gd'.
+    """
+    Z = Y.copy()
+    for _ in range(max_iter):
+        grad = np.zeros_like(Z)
+        for b in range(Z.shape[0]):
+            grad_ms = gaussian_filter(blur(Z[b], sigma_blur) - Y[b], sigma=sigma_blur)
+            grad_sar = laplace(laplace(Z[b]))
+            grad_pan = lambdas[b] * (synth_pan(Z, lambdas) - x)
+            grad[b] = beta * grad_ms + alpha * grad_sar + beta * grad_pan
+        Z -= lr * grad
+    return Z
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the MAP-SAR solvers (iterations, wall time, final loss) on the same crop.")
+    parser.add_argument("--size", type=int, default=1024, help="side of the square synthetic crop")
+    parser.add_argument("--max-iter", type=int, default=500)
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument("--no-baseline", action="store_true",
+                        help="skip the original spatial-domain gradient descent (slowest by far)")
+    args = parser.parse_args()
+
+    Y, x = synthetic_crop(args.size)
+    lambdas = np.array(LAMBDA, dtype=np.float32)
+    print(f"Crop: {Y.shape[0]} bands of {args.size}x{args.size}")
+    print("gd, cg and direct work in the DCT domain; 'spatial' is the original gradient descent (the baseline),")
+    print("run for as many iterations as gd, whose iterates it shares.")
+    print(f"{'solver':<8} {'iterations':>10} {'time (s)':>10} {'loss':>16}")
+    gd_iterations = args.max_iter
+    for solver in ('gd', 'cg', 'direct'):
+        info = {}
+        start = time.perf_counter()
+        Z = optimize_map_sar_gd(Y, x, lambdas, max_iter=args.max_iter, tol=args.tol, solver=solver, info=info, verbose=False)
+        elapsed = time.perf_counter() - start
+        loss = loss_map_sar(Z, Y, x, lambdas, alpha=0.001, beta=1.0)
+        print(f"{solver:<8} {info['iterations']:>10} {elapsed:>10.3f} {loss:>16.6g}")
+        if solver == 'gd':
+            gd_iterations = info['iterations']
+    if not args.no_baseline:
+        start = time.perf_counter()
+        Z = spatial_gd(Y, x, lambdas, max_iter=gd_iterations)
+        elapsed = time.perf_counter() - start
+        loss = loss_map_sar(Z, Y, x, lambdas, alpha=0.001, beta=1.0)
+        print(f"{'spatial':<8} {gd_iterations:>10} {elapsed:>10.3f} {loss:>16.6g}")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,60 @@
 import numpy as np
 import cv2
+from affine import Affine
 import matplotlib.pyplot as plt
 import tifffile as tiff
 import gc
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity, mean_squared_error
 from scipy.stats import pearsonr
 import os
+import time
 from scipy.ndimage import gaussian_filter, laplace
 from scipy.optimize import minimize
+from scipy.fft import dctn, idctn
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import importlib.util
+import sys
 
-def crop_and_straighten(img, threshold=10, visualize=False):
-    if len(img.shape) == 2 or img.shape[2] == 1:
-        gray = img if len(img.shape) == 2 else img[:, :, 0]
-    else:
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+GRAM_SCHMIDT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Gram-Schmidt', 'src')
 
-    # Normalize to 8-bit for contour processing
-    gray_8bit = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
+def load_shared_module(name):
+    """
+    Imports a module of Gram-Schmidt/src (e.g. metrics, raster_io), shared by all the methods. Its package is
+    registered under another name, since both folders are called `src`.
+    """
+    if "gram_schmidt_src" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("gram_schmidt_src", os.path.join(GRAM_SCHMIDT_SRC, '__init__.py'),
+                                                      submodule_search_locations=[GRAM_SCHMIDT_SRC])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = package
+        spec.loader.exec_module(package)
+    return importlib.import_module(f"gram_schmidt_src.{name}")
+
+shared_metrics = load_shared_module("metrics")
+raster_io = load_shared_module("raster_io")
+
+def footprint_mask(img, threshold=10):
+    """Mask (uint8, 0/255) of the valid region of a band: pixels above `threshold` once normalised to 8-bit."""
+    gray_8bit = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
     gray_8bit = gray_8bit.astype(np.uint8)
-
-    # Create binary mask for valid region
     _, mask = cv2.threshold(gray_8bit, threshold, 255, cv2.THRESH_BINARY)
+    return mask
+
+def footprint_transform(img, threshold=10, decimation=4):
+    """
+    Estimates the perspective transform that straightens and crops the valid footprint of a band.
+    The footprint is the minimum-area rectangle around the largest contour of the valid mask, which is computed on
+    a copy decimated by `decimation` (the corners are then accurate to about `decimation` pixels, 1 is exact).
+    Args:
+        img (numpy.ndarray): Band (H, W), or (H, W, C) image whose first channel is used.
+        threshold (int): Validity threshold on the 8-bit normalised band.
+        decimation (int): Stride of the decimated copy the contour is searched on.
+    Returns:
+        tuple: (3x3 perspective matrix, (width, height) of the straightened image)
+    """
+    gray = img if img.ndim == 2 else img[:, :, 0]
+    mask = footprint_mask(gray[decimation // 2::decimation, decimation // 2::decimation], threshold)
 
     # Find contours
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -31,19 +65,88 @@ def crop_and_straighten(img, threshold=10, visualize=False):
     # Largest contour
     cnt = max(contours, key=cv2.contourArea)
     rect = cv2.minAreaRect(cnt)
-    box = cv2.boxPoints(rect)
-    box = np.intp(box)
-    # print(box)
+    if decimation > 1:
+        # back to full resolution: the decimated pixels sample the centres of blocks of decimation pixels
+        (cx, cy), (w, h), angle = rect
+        offset = decimation // 2
+        rect = ((cx * decimation + offset, cy * decimation + offset), (w * decimation, h * decimation), angle)
+    box = np.intp(cv2.boxPoints(rect))
 
     width, height = int(rect[1][0]), int(rect[1][1])
+
     dst_pts = np.array([[0, height-1],
                         [0, 0],
                         [width-1, 0],
                         [width-1, height-1]], dtype="float32")
     src_pts = box.astype("float32")
 
-    M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-    warped = cv2.warpPerspective(img, M, (width, height))
+    return cv2.getPerspectiveTransform(src_pts, dst_pts), (width, height)
+
+def warp_bands(img, M, size):
+    """
+    Applies one perspective transform to every band of an (H, W) or (H, W, C) image, four bands per
+    cv2.warpPerspective call (the most it warps at once).
+    """
+    if img.ndim == 2 or img.shape[2] <= 4:
+        return cv2.warpPerspective(img, M, size)
+    warped = np.empty((size[1], size[0], img.shape[2]), dtype=img.dtype)
+    for c in range(0, img.shape[2], 4):
+        warped[:, :, c:c + 4] = cv2.warpPerspective(np.ascontiguousarray(img[:, :, c:c + 4]), M, size).reshape(size[1], size[0], -1)
+    return warped
+
+_footprint_transforms = {} # (sensor grid, threshold, decimation) -> (M, size), see register_bands
+
+def grid_key(meta):
+    """Hashable key of the pixel grid of a raster (CRS, geotransform and shape), None if it is not georeferenced."""
+    if meta is None or not meta.get('crs'):
+        return None
+    return (str(meta['crs']), tuple(meta['transform']), meta['height'], meta['width'])
+
+def registered_meta(meta, M, size):
+    """
+    Metadata of the straightened grid: the footprint transform maps source pixels to registered pixels, so the
+    registered geotransform is the source one composed with its inverse (rotated grids are valid GeoTIFFs).
+    """
+    M_inv = np.linalg.inv(M)
+    M_inv /= M_inv[2, 2]
+    # cv2 puts pixel centres on integer coordinates, geotransforms on the pixel corners
+    to_centres = Affine.translation(-0.5, -0.5)
+    inverse = Affine(*M_inv[0], *M_inv[1])
+    meta = dict(meta, width=size[0], height=size[1])
+    meta['transform'] = meta['transform'] * ~to_centres * inverse * to_centres
+    return meta
+
+def register_bands(img, meta=None, threshold=10, decimation=4):
+    """
+    Straightens and crops bands that share one sensor grid: the footprint transform is estimated once, from the
+    first band, and applied to all the bands with a single batched warp.
+    Args:
+        img (numpy.ndarray): (H, W) band or (H, W, C) stack of bands on the same grid.
+        meta (dict): Raster metadata of the grid. When it is georeferenced the transform is cached per grid (and
+                     threshold and decimation), so other images on the same grid reuse it without another contour search.
+        threshold (int): Validity threshold on the 8-bit normalised band.
+        decimation (int): Stride of the decimated mask the footprint is estimated on.
+    Returns:
+        tuple: (registered image of shape (height, width[, C]), metadata of the registered grid or None)
+    """
+    grid = grid_key(meta)
+    key = None if grid is None else (grid, threshold, decimation)
+    if key is not None and key in _footprint_transforms:
+        M, size = _footprint_transforms[key]
+    else:
+        M, size = footprint_transform(img, threshold, decimation)
+        if key is not None:
+            _footprint_transforms[key] = (M, size)
+    return warp_bands(img, M, size), registered_meta(meta, M, size) if meta is not None else None
+
+def crop_and_straighten(img, threshold=10, visualize=False):
+    if len(img.shape) == 2 or img.shape[2] == 1:
+        gray = img if len(img.shape) == 2 else img[:, :, 0]
+    else:
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+    M, size = footprint_transform(gray, threshold, decimation=1)
+    warped = cv2.warpPerspective(img, M, size)
 
     if visualize:
         plt.imshow(warped, cmap='gray' if len(warped.shape) == 2 else None)
@@ -55,85 +158,29 @@ def crop_and_straighten(img, threshold=10, visualize=False):
 
 
 def compute_quality_metrics(ref_img, test_img, PSNR=True):
+    """Mean PSNR (uint16 data range) or mean relative RMSE over all the bands of H x W x C images."""
     assert ref_img.shape == test_img.shape, "Images must have the same shape"
     assert ref_img.ndim == 3, "Images must be H x W x C"
 
-    psnr_list = []
-    cc_list = []
-    ssim_list = []
-    rmse_list = []
-
-    for i in range(ref_img.shape[2]):
-        ref_band = ref_img[:, :, i].astype(np.float64)
-        test_band = test_img[:, :, i].astype(np.float64)
-
-        # Use fixed data range for uint16 images
-        data_range = 65535.0
-
-        if PSNR:
-          psnr_val = peak_signal_noise_ratio(ref_band, test_band, data_range=data_range)
-          psnr_list.append(psnr_val)
-
-
-        # cc_val, _ = pearsonr(ref_band.flatten(), test_band.flatten())
-        # ssim_val = structural_similarity(ref_band, test_band, data_range=data_range)
-        else:
-          rmse_val = np.sqrt(mean_squared_error(ref_band, test_band))
-          mean_ref = np.mean(ref_band)
-          rel_rmse = rmse_val / mean_ref if mean_ref != 0 else 0
-          rmse_list.append(rel_rmse)
-
-
-        # cc_list.append(cc_val)
-        # ssim_list.append(ssim_val)
-
-        if PSNR:
-            return {
-              "PSNR": np.mean(psnr_list)
-            }
-        else:
-            return {
-                "RMSE": np.mean(rmse_list)
-            }
+    # Use fixed data range for uint16 images
+    metrics = shared_metrics.compute_metrics(ref_img, test_img, layout='hwc', data_range=65535.0)
+    if PSNR:
+        return {
+          "PSNR": np.mean(metrics['band_psnr'])
+        }
+    mean_ref = metrics['band_mean_reference']
+    rel_rmse = np.divide(metrics['band_rmse'], mean_ref, out=np.zeros_like(mean_ref), where=mean_ref != 0)
+    return {
+        "RMSE": np.mean(rel_rmse)
+    }
 
 def calculate_ergas(original_ms, pansharpened_ms, ratio):
-    if original_ms.shape != pansharpened_ms.shape:
-        raise ValueError("Images must be the same shape. Resample the original MS image first.")
-
-    N = original_ms.shape[2]
-    ergas_sum = 0
-
-    for i in range(N):
-        ref_band = original_ms[:, :, i].astype(np.float64)
-        pan_band = pansharpened_ms[:, :, i].astype(np.float64)
-
-        rmse = np.sqrt(mean_squared_error(ref_band, pan_band))
-        mean_val = np.mean(ref_band)
-
-        ergas_sum += (rmse / mean_val) ** 2
-
-    ergas = 100 * (ratio) * np.sqrt(ergas_sum / N)
-    return ergas
-
-
-def compute_sam(img1, img2, eps=1e-8):
-    # Flatten spatial dimensions
-    X = img1.reshape(-1, img1.shape[-1]).astype(np.float32)
-    Y = img2.reshape(-1, img2.shape[-1]).astype(np.float32)
+    return shared_metrics.compute_metrics(original_ms, pansharpened_ms, ratio, layout='hwc')['ERGAS']
 
-    # Compute dot product and norms
-    dot_product = np.sum(X * Y, axis=1)
-    norm_x = np.linalg.norm(X, axis=1)
-    norm_y = np.linalg.norm(Y, axis=1)
 
-    # Avoid division by zero
-    denom = np.clip(norm_x * norm_y, eps, None)
-
-    # Compute angle (in radians)
-    sam = np.arccos(np.clip(dot_product / denom, -1.0, 1.0))
-    sam_map = sam.reshape(img1.shape[0], img1.shape[1])
-
-    mean_sam = np.mean(sam)
+def compute_sam(img1, img2, eps=1e-8, backend='numpy'):
+    sam_map = shared_metrics.spectral_angle_map(img1, img2, layout='hwc', eps=eps, backend=backend)
+    mean_sam = np.mean(sam_map, dtype=np.float64)
 
     sam_map_safe = np.clip(sam_map, 1e-6, None)
 
@@ -166,57 +213,349 @@ def synth_pan(z, lambdas):
     return np.tensordot(lambdas, z, axes=(0, 0))  # shape (H, W)
 
 
-def loss_map_sar(Z, Y, x, lambdas, alpha, beta):
-    """Compute the MAP loss with SAR prior."""
-    B, H, W  = Z.shape
-    loss_val = 0.0
+def map_sar_loss_terms(ms_res, lap_z, pan_residual, alpha, beta):
+    """
+    MAP loss from the residuals the gradient step already computes: blur(Z) - Y, laplace(Z) and synth_pan(Z) - x.
+    The residuals can be spatial or DCT coefficients alike (the orthonormal DCT preserves sums of squares).
+    """
+    return float(beta * np.vdot(ms_res, ms_res) + alpha * np.vdot(lap_z, lap_z) + beta * np.vdot(pan_residual, pan_residual))
 
-    for b in range(B):
-        zb = Z[b]
-        yb = Y[b]
-        smooth = laplace(zb)
-        loss_val += beta * np.sum((blur(zb) - yb) ** 2)
-        loss_val += alpha * np.sum(smooth ** 2)
 
-    x_hat = synth_pan(Z, lambdas)
-    loss_val += beta * np.sum((x_hat - x) ** 2)
+def loss_map_sar(Z, Y, x, lambdas, alpha, beta, sigma_blur=1.2):
+    """
+    Compute the MAP loss with SAR prior.
+    All bands are evaluated at once in the DCT domain, where blur and laplace are pointwise products.
+    """
+    blur_hat, lap_hat = map_sar_operators(Z.shape[1:], sigma_blur)
+    Z_hat = dctn(Z, axes=(1, 2), norm='ortho', workers=-1)
+    ms_res = Z_hat * blur_hat - dctn(Y, axes=(1, 2), norm='ortho', workers=-1)
+    lap_z = Z_hat * lap_hat
+    pan_residual = synth_pan(Z_hat, np.asarray(lambdas, dtype=Z_hat.dtype)) - dctn(x, norm='ortho', workers=-1)
+    return map_sar_loss_terms(ms_res, lap_z, pan_residual, alpha, beta)
 
-    return loss_val
 
-def optimize_map_sar_gd(Y, x, lambdas, alpha=0.001, beta=1.0, sigma_blur=1.2, lr=0.05, max_iter=50):
+class SolverHistory:
     """
-    Gradient descent of MAP-SAR
+    Per-iteration record of a MAP-SAR solve: loss, gradient norm and wall time since the start of the solve.
+
+    Pass an instance to optimize_map_sar_gd(history=...) to monitor convergence. The optional stop_when callable
+    receives the history after every iteration and ends the solve when it returns True, so that callers can plug
+    in their own early-stopping policies.
     """
-    Y = Y.astype(np.float32)
-    x = x.astype(np.float32)
-    Z = Y.copy()
-    for it in range(max_iter):
-        grad = np.zeros_like(Z)
 
-        for b in range(Z.shape[0]):
-            zb = Z[b]
-            yb = Y[b]
+    def __init__(self, stop_when=None):
+        self.loss = []
+        self.grad_norm = []
+        self.elapsed = []
+        self.stop_when = stop_when
+        self._start = time.perf_counter()
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def record(self, loss, grad_norm):
+        """Appends one iteration. Returns True if the early-stopping policy asks to stop."""
+        self.loss.append(float(loss))
+        self.grad_norm.append(float(grad_norm))
+        self.elapsed.append(time.perf_counter() - self._start)
+        return self.stop_when is not None and bool(self.stop_when(self))
 
-            # Gradient of the MS term
-            diff_ms = blur(zb) - yb
-            grad_ms = gaussian_filter(diff_ms, sigma=sigma_blur)
+    def __len__(self):
+        return len(self.loss)
 
-            # Gradient of SAR prior (Laplacian)
-            grad_sar = laplace(laplace(zb))  # second derivative
+    def as_dict(self):
+        return {'loss': self.loss, 'grad_norm': self.grad_norm, 'elapsed': self.elapsed}
 
-            # Gradient of the PAN term
-            pan_residual = synth_pan(Z) - x
-            grad_pan = lambdas[b] * pan_residual
 
-            grad[b] = beta * grad_ms + alpha * grad_sar + beta * grad_pan
+def gaussian_kernel1d(sigma, truncate=4.0):
+    """Normalised 1D Gaussian kernel, identical to the one used by scipy.ndimage.gaussian_filter."""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def symmetric_transfer(kernel, n):
+    """
+    Transfer function of a symmetric 1D kernel in the DCT-II domain.
+    With half-sample symmetric boundaries (scipy.ndimage mode='reflect') a symmetric convolution is diagonal
+    in the DCT-II basis, so filtering becomes a pointwise product with these coefficients.
+    """
+    radius = len(kernel) // 2
+    freqs = np.pi * np.arange(n) / n
+    transfer = np.full(n, kernel[radius], dtype=np.float64)
+    for j in range(1, radius + 1):
+        transfer += 2 * kernel[radius + j] * np.cos(freqs * j)
+    return transfer
+
+
+def map_sar_operators(shape, sigma_blur=1.2):
+    """
+    Precomputed DCT-domain transfer functions of the MAP-SAR operators for images of the given (H, W) shape.
+    Returns:
+        tuple: (blur transfer, Laplacian transfer), both (H, W) float32. They reproduce blur() and
+               scipy.ndimage.laplace exactly (same kernels, same 'reflect' boundaries).
+    """
+    height, width = shape
+    gauss = gaussian_kernel1d(sigma_blur)
+    blur_hat = np.outer(symmetric_transfer(gauss, height), symmetric_transfer(gauss, width))
+    second_diff = np.array([1.0, -2.0, 1.0])
+    lap_hat = symmetric_transfer(second_diff, height)[:, None] + symmetric_transfer(second_diff, width)[None, :]
+    return blur_hat.astype(np.float32), lap_hat.astype(np.float32)
+
+
+def _map_sar_gd(Z_hat, Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, lr, max_iter, tol, loss_tol, verbose=True, history=None):
+    """Gradient descent on the DCT coefficients (updates Z_hat in place). Returns the number of iterations run."""
+    ms_res = np.empty_like(Z_hat) # blur(Z) - Y
+    lap_z = np.empty_like(Z_hat) # laplace(Z)
+    grad = np.empty_like(Z_hat)
+    grad_norm0 = None
+    prev_loss = None
+    for it in range(max_iter):
+        np.multiply(Z_hat, blur_hat, out=ms_res)
+        ms_res -= Y_hat
+        np.multiply(Z_hat, lap_hat, out=lap_z)
+        pan_residual = np.tensordot(lambdas, Z_hat, axes=(0, 0)) - x_hat # once per iteration, shared by all bands
+
+        # Gradient: blur^T(blur(z) - y) + alpha * laplace(laplace(z)) + lambda_b * (synth_pan(Z) - x)
+        np.multiply(ms_res, blur_hat, out=grad)
+        grad *= beta
+        grad += (alpha * lap_hat) * lap_z
+        grad += (beta * lambdas)[:, None, None] * pan_residual
+
+        # The loss comes for free from the residuals already computed for the gradient (Parseval)
+        loss = map_sar_loss_terms(ms_res, lap_z, pan_residual, alpha, beta)
+        grad_norm = np.linalg.norm(grad)
+        if grad_norm0 is None:
+            grad_norm0 = grad_norm
+        if history is not None and history.record(loss, grad_norm):
+            if verbose:
+                print(f"Stopped by the history policy at iteration {it}: loss = {loss:.2f}")
+            return it
+
+        if verbose and it % 10 == 0:
+            print(f"Iteration {it}: gradient norm = {grad_norm:.2f}, loss = {loss:.2f}")
+        if grad_norm <= tol * grad_norm0:
+            if verbose:
+                print(f"Converged at iteration {it}: gradient norm = {grad_norm:.2f}")
+            return it
+        if loss_tol is not None and prev_loss is not None and prev_loss - loss <= loss_tol * prev_loss:
+            if verbose:
+                print(f"Loss stalled at iteration {it}: loss = {loss:.2f}")
+            return it
+        prev_loss = loss
 
         # Gradient descent update
-        Z -= lr * grad
+        grad *= lr
+        Z_hat -= grad
+    return max_iter
 
-        if it % 10 == 0:
-            print(f"Iteration {it}: gradient norm = {np.linalg.norm(grad):.2f}") # doesn't have to go to zero, just 1e-3 times the original ideally
 
-    return Z
+def _map_sar_system(Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta):
+    """
+    Normal equations of the MAP-SAR loss in the DCT domain: for every frequency, (d I + beta * lambda lambda^T) z = rhs
+    with d = beta * blur^2 + alpha * laplace^2. Returns d (H, W) and rhs (B, H, W).
+    """
+    diag = beta * blur_hat ** 2 + alpha * lap_hat ** 2
+    rhs = (beta * blur_hat) * Y_hat + (beta * lambdas)[:, None, None] * x_hat
+    return diag, rhs
+
+
+def _map_sar_direct(Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, history=None):
+    """
+    Exact minimiser of the MAP-SAR loss: the B x B system of every frequency is a diagonal plus a rank-one term,
+    inverted in closed form with the Sherman-Morrison formula.
+    """
+    diag, rhs = _map_sar_system(Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta)
+    diag = np.maximum(diag, np.finfo(np.float32).tiny) # only singular when alpha = 0 and the blur cancels a frequency
+    proj = np.tensordot(lambdas, rhs, axes=(0, 0)) * (beta / (diag + beta * np.dot(lambdas, lambdas)))
+    rhs -= lambdas[:, None, None] * proj
+    rhs /= diag
+    if history is not None:
+        ms_res = rhs * blur_hat - Y_hat
+        history.record(map_sar_loss_terms(ms_res, rhs * lap_hat, synth_pan(rhs, lambdas) - x_hat, alpha, beta), 0.0)
+    return rhs
+
+
+def _map_sar_cg(Z_hat, Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, max_iter, tol, verbose=True, history=None):
+    """
+    Jacobi-preconditioned conjugate gradient on the normal equations in the DCT domain (updates Z_hat in place).
+    Returns the number of iterations run.
+    """
+    diag, rhs = _map_sar_system(Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta)
+    precond = diag + beta * (lambdas ** 2)[:, None, None] # diagonal of the system
+
+    def apply_system(v):
+        return diag * v + (beta * lambdas)[:, None, None] * np.tensordot(lambdas, v, axes=(0, 0))
+
+    residual = rhs - apply_system(Z_hat)
+    res_norm0 = np.linalg.norm(residual)
+    z = residual / precond
+    direction = z.copy()
+    rz = np.vdot(residual, z)
+    # loss(Z) = Z.A.Z - 2 rhs.Z + const = const - Z.(rhs + residual), one dot product per iteration
+    loss_const = beta * (np.vdot(Y_hat, Y_hat) + np.vdot(x_hat, x_hat))
+    for it in range(max_iter):
+        res_norm = np.linalg.norm(residual) # the residual is minus the gradient
+        if history is not None and history.record(loss_const - np.vdot(Z_hat, rhs + residual), res_norm):
+            if verbose:
+                print(f"Stopped by the history policy at iteration {it}: residual norm = {res_norm:.2f}")
+            return it
+        if verbose and it % 10 == 0:
+            print(f"Iteration {it}: residual norm = {res_norm:.2f}")
+        if res_norm <= tol * res_norm0:
+            if verbose:
+                print(f"Converged at iteration {it}: residual norm = {res_norm:.2f}")
+            return it
+        a_dir = apply_system(direction)
+        step = rz / np.vdot(direction, a_dir)
+        Z_hat += step * direction
+        residual -= step * a_dir
+        np.divide(residual, precond, out=z)
+        rz_new = np.vdot(residual, z)
+        direction *= rz_new / rz
+        direction += z
+        rz = rz_new
+    return max_iter
+
+
+def optimize_map_sar_gd(Y, x, lambdas, alpha=0.001, beta=1.0, sigma_blur=1.2, lr=0.05, max_iter=50, tol=1e-3, loss_tol=None,
+                        solver='gd', info=None, verbose=True, fft_workers=-1, history=None):
+    """
+    MAP-SAR estimation of the sharpened image Z (B, H, W) from the upsampled MS image Y (B, H, W) and the PAN image x (H, W).
+
+    The blur and (bi-)Laplacian operators are diagonal in the DCT domain (see map_sar_operators), and the DCT is
+    orthonormal, so the solvers work on the DCT coefficients of all bands at once and only one inverse transform
+    is needed at the end.
+
+    solver:
+        'gd': gradient descent with step lr (the original method). Every iteration is a few pointwise products and
+              the PAN residual is computed once; the iterates are the same as spatial-domain gradient descent with
+              gaussian_filter/laplace. Stops after max_iter iterations, when the gradient norm falls below tol times
+              its initial value, or when the relative decrease of the loss falls below loss_tol (if given).
+        'cg': preconditioned conjugate gradient on the normal equations, stopping when the residual norm falls below
+              tol times its initial value (usually a handful of iterations).
+        'direct': exact minimiser of the loss (the loss is quadratic in Z), solved per frequency in closed form.
+    info: Optional dict, filled with the solver name and the number of iterations run.
+    verbose: Print the solver progress.
+    fft_workers: Number of threads used by each DCT (-1 for all cores).
+    history: Optional SolverHistory, filled with the loss, gradient norm and wall time of every iteration
+             (computed from quantities the solvers already have, without extra transforms), and whose stop_when
+             policy can end the solve early.
+    """
+    if history is not None:
+        history.start()
+    Y = Y.astype(np.float32)
+    x = x.astype(np.float32)
+    lambdas = np.asarray(lambdas, dtype=np.float32)
+    blur_hat, lap_hat = map_sar_operators(Y.shape[1:], sigma_blur)
+
+    Y_hat = dctn(Y, axes=(1, 2), norm='ortho', workers=fft_workers)
+    x_hat = dctn(x, norm='ortho', workers=fft_workers)
+
+    if solver == 'gd':
+        Z_hat = Y_hat.copy()
+        iterations = _map_sar_gd(Z_hat, Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, lr, max_iter, tol, loss_tol, verbose, history)
+    elif solver == 'cg':
+        Z_hat = Y_hat.copy()
+        iterations = _map_sar_cg(Z_hat, Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, max_iter, tol, verbose, history)
+    elif solver == 'direct':
+        Z_hat = _map_sar_direct(Y_hat, x_hat, blur_hat, lap_hat, lambdas, alpha, beta, history)
+        iterations = 0
+    else:
+        raise ValueError(f"Unknown solver '{solver}', expected 'gd', 'cg' or 'direct'.")
+
+    if info is not None:
+        info['solver'] = solver
+        info['iterations'] = iterations
+    return idctn(Z_hat, axes=(1, 2), norm='ortho', workers=fft_workers)
+
+def map_sar_halo(sigma_blur=1.2):
+    """Tile overlap for tiled MAP-SAR: four times the joint support of the blur kernel and the bi-Laplacian."""
+    return 4 * (int(4.0 * sigma_blur + 0.5) + 2)
+
+
+def map_sar_tile_size(memory_budget_mb, nb_bands=4, overlap=None, sigma_blur=1.2):
+    """
+    Largest tile side (multiple of 64) whose MAP-SAR working set fits in the given memory budget.
+    A tile holds about eight float32 planes per band (input, DCT coefficients, iterate and gradient-descent
+    buffers) plus the PAN and the blend weights.
+    """
+    overlap = map_sar_halo(sigma_blur) if overlap is None else overlap
+    bytes_per_pixel = 4 * (8 * nb_bands + 4)
+    side = int(np.sqrt(memory_budget_mb * 2**20 / bytes_per_pixel)) - 2 * overlap
+    return max(64, side // 64 * 64)
+
+
+def _blend_ramp(length, start_taper, end_taper, overlap):
+    """1D blending weights of an extended tile: linear ramps across the 2 * overlap band shared with a neighbour."""
+    ramp = np.ones(length, dtype=np.float32)
+    taper = (np.arange(2 * overlap, dtype=np.float32) + 0.5) / (2 * overlap)
+    n = min(2 * overlap, length)
+    if start_taper:
+        ramp[:n] = np.minimum(ramp[:n], taper[:n])
+    if end_taper:
+        ramp[length - n:] = np.minimum(ramp[length - n:], taper[:n][::-1])
+    return ramp
+
+
+def optimize_map_sar_tiled(Y, x, lambdas, tile_size=1024, overlap=None, workers=None, memory_budget_mb=None, out=None,
+                           **solver_kwargs):
+    """
+    MAP-SAR over a full scene in overlapping tiles, so that memory does not grow with the scene size.
+
+    Each tile is extended by `overlap` pixels on every side (default: map_sar_halo, a few times the blur and
+    Laplacian support), solved independently with optimize_map_sar_gd, and blended back with linear ramps over the
+    shared bands so that the seams disappear. Tiles run in parallel threads (the DCTs and array operations release
+    the GIL).
+
+    Y: (B, H, W) upsampled MS image, x: (H, W) PAN image, lambdas: spectral weights of the PAN.
+    tile_size: Side of the tile cores; ignored if memory_budget_mb is given.
+    workers: Number of tiles solved concurrently (default: number of cores).
+    memory_budget_mb: Memory budget per worker, used to size the tiles (see map_sar_tile_size).
+    out: Optional float32 (B, H, W) array (e.g. a np.memmap) receiving the result.
+    solver_kwargs: Passed to optimize_map_sar_gd (alpha, beta, sigma_blur, solver, max_iter, ...).
+    """
+    nb_bands, height, width = Y.shape
+    sigma_blur = solver_kwargs.get('sigma_blur', 1.2)
+    overlap = map_sar_halo(sigma_blur) if overlap is None else overlap
+    if memory_budget_mb is not None:
+        tile_size = map_sar_tile_size(memory_budget_mb, nb_bands, overlap, sigma_blur)
+    workers = workers or os.cpu_count()
+    solver_kwargs.setdefault('verbose', False)
+    solver_kwargs.setdefault('fft_workers', 1 if workers > 1 else -1)
+
+    if out is None:
+        out = np.zeros(Y.shape, dtype=np.float32)
+    else:
+        out[...] = 0
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+
+    tiles = []
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            r0, c0 = max(row - overlap, 0), max(col - overlap, 0)
+            r1, c1 = min(row + tile_size + overlap, height), min(col + tile_size + overlap, width)
+            tiles.append((r0, r1, c0, c1))
+    print(f"Running MAP-SAR on {len(tiles)} tiles of {tile_size}x{tile_size} (+{overlap} px overlap) with {workers} workers...")
+
+    def solve(tile):
+        r0, r1, c0, c1 = tile
+        return optimize_map_sar_gd(Y[:, r0:r1, c0:c1], x[r0:r1, c0:c1], lambdas, **solver_kwargs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for done, (tile, Z_tile) in enumerate(zip(tiles, executor.map(solve, tiles)), start=1):
+            r0, r1, c0, c1 = tile
+            weights = np.outer(_blend_ramp(r1 - r0, r0 > 0, r1 < height, overlap),
+                               _blend_ramp(c1 - c0, c0 > 0, c1 < width, overlap))
+            out[:, r0:r1, c0:c1] += Z_tile * weights
+            weight_sum[r0:r1, c0:c1] += weights
+            if done % 10 == 0 or done == len(tiles):
+                print(f"  {done}/{len(tiles)} tiles done")
+
+    out /= weight_sum
+    return out
+
 
 def crop_center(img, cropx, cropy):
     """
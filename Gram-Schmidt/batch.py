@@ -0,0 +1,330 @@
+"""
+Batch pansharpening of many Landsat 8 scenes.
+
+Scenes are folders holding the band GeoTIFFs (same discovery rules as load_bands). They are given either as
+a directory whose sub-folders are scenes, or as a manifest file listing one scene folder per line.
+Each scene is processed in its own worker process; a failing scene is reported and the batch carries on, even
+when its worker is killed (e.g. by the OS when out of memory).
+
+    python batch.py --scenes /data/landsat --method gs --workers 8 --memory-budget 4096 --output sharpened/
+    python batch.py --manifest scenes.txt --method hpf --output sharpened/ --evaluate
+    python batch.py --scenes /data/landsat --method map-sar --cache-dir band_cache/
+    python batch.py --scenes /data/landsat --method gs --preview 16 --output previews/
+"""
+from src.band_operations import find_band_files, ms_band_paths, load_bands, resample_ms_to_pan, write_bands
+from src.band_cache import BandCache, cached_load_bands
+from src.high_pass import pansharpen_hpf_strips
+from src.metrics import evaluate_at_ms_resolution, qnr_rasters
+from src.preview import preview_gs, preview_hpf, read_preview, upsample_preview, write_thumbnail
+from src.profiling import Profiler
+from src.raster_io import BLOCK_SIZE
+from src.tiling import pansharpen_gs_tiled
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+import numpy as np
+import rasterio
+
+logger = logging.getLogger("batch")
+
+METHODS = ('gs', 'hpf', 'map-sar')
+MAP_SAR_LAMBDAS = [0.0842, 0.5375, 0.3784, 0.0000] # Landsat 8 spectral weights of the PAN band (see Bayesian_Methods/main.py)
+BAYESIAN_OPS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Bayesian_Methods', 'src', 'bayesian_op.py')
+
+def load_bayesian_ops():
+    """Imports Bayesian_Methods/src/bayesian_op.py (its `src` folder would clash with ours on sys.path)."""
+    spec = importlib.util.spec_from_file_location("bayesian_op", BAYESIAN_OPS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def discover_scenes(scenes_dir=None, manifest=None):
+    """
+    Lists the scene folders to process.
+    Args:
+        scenes_dir (str): Directory whose sub-folders are scenes (or which is itself a scene).
+        manifest (str): Text file with one scene folder per line; blank lines and '#' comments are ignored,
+                        relative paths are relative to the manifest.
+    Returns:
+        list: Scene folder paths.
+    """
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest) as f:
+            lines = [line.split('#', 1)[0].strip() for line in f]
+        return [os.path.join(base, line) for line in lines if line]
+    subdirs = sorted(os.path.join(scenes_dir, d) for d in os.listdir(scenes_dir)
+                     if os.path.isdir(os.path.join(scenes_dir, d)))
+    return subdirs or [scenes_dir]
+
+def tile_size_for_budget(memory_budget_mb, nb_bands=4):
+    """Largest tile side (multiple of the output block size) whose working set stays within half of the memory budget."""
+    bytes_per_pixel = (nb_bands + 1) * (4 + 8) + 8 # float32 MS + PAN tile, float64 centred copy for the moments, residual
+    side = int(np.sqrt(memory_budget_mb * 2**20 / 2 / bytes_per_pixel))
+    return max(BLOCK_SIZE, side // BLOCK_SIZE * BLOCK_SIZE)
+
+def strip_rows_for_budget(memory_budget_mb, width, nb_bands=4):
+    """Largest HPF strip height (multiple of the output block size) whose working set stays within half of the memory budget."""
+    bytes_per_pixel = nb_bands * 4 + 3 * 4 # float32 MS strip, PAN strip, its blur and high frequencies
+    rows = int(memory_budget_mb * 2**20 / 2 / (width * bytes_per_pixel))
+    return max(BLOCK_SIZE, rows // BLOCK_SIZE * BLOCK_SIZE)
+
+def data_segment_size():
+    """Current size of the process data segment in bytes (VmData, what RLIMIT_DATA limits), or None if unknown."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmData:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+_started_scenes = None # queue on which a worker reports each scene it starts, see run_pool
+
+def init_worker(memory_budget_mb, started_scenes=None):
+    """
+    Caps the data segment of a worker to its current size (interpreter and libraries, already imported)
+    plus the memory budget, and the GDAL block cache, so that an oversized scene fails on its own.
+    """
+    global _started_scenes
+    _started_scenes = started_scenes
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    if memory_budget_mb:
+        os.environ['GDAL_CACHEMAX'] = str(max(64, memory_budget_mb // 8))
+        baseline = data_segment_size()
+        if baseline is None:
+            return
+        limit = baseline + memory_budget_mb * 2**20
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        if hard == resource.RLIM_INFINITY or hard > limit:
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+
+def run_gs(scene_dir, output_path, memory_budget_mb, cache_dir=None):
+    # the tiled engines stream from the GeoTIFFs, there is nothing to cache
+    tile_size = tile_size_for_budget(memory_budget_mb) if memory_budget_mb else 1024
+    bands = find_band_files(scene_dir)
+    if bands is None:
+        raise FileNotFoundError(f"Required bands not found in {scene_dir}")
+    pansharpen_gs_tiled(ms_band_paths(bands), bands['B8'][0], output_path, tile_size=tile_size)
+
+def run_hpf(scene_dir, output_path, memory_budget_mb, cache_dir=None):
+    bands = find_band_files(scene_dir)
+    if bands is None:
+        raise FileNotFoundError(f"Required bands not found in {scene_dir}")
+    ms_paths = ms_band_paths(bands)
+    strip_rows = 512
+    if memory_budget_mb:
+        with rasterio.open(bands['B8'][0]) as src:
+            width = src.width
+        strip_rows = strip_rows_for_budget(memory_budget_mb, width, len(ms_paths))
+    pansharpen_hpf_strips(ms_paths, bands['B8'][0], output_path, strip_rows=strip_rows)
+
+def run_map_sar(scene_dir, output_path, memory_budget_mb, cache_dir=None):
+    bayesian_op = load_bayesian_ops()
+    if cache_dir:
+        loaded = cached_load_bands(scene_dir, BandCache(cache_dir), workers=1)
+        if loaded is None:
+            raise FileNotFoundError(f"Required bands not found in {scene_dir}")
+        _, _, ms, pan, pan_meta = loaded
+    else:
+        loaded = load_bands(scene_dir)
+        if loaded is None:
+            raise FileNotFoundError(f"Required bands not found in {scene_dir}")
+        ms_list, ms_meta_list, pan, pan_meta = loaded
+        # scenes already run in parallel processes, so each scene resamples its bands sequentially
+        ms = resample_ms_to_pan(ms_list, ms_meta_list, pan.shape, pan_meta, workers=1)
+    lambdas = np.array(MAP_SAR_LAMBDAS[:ms.shape[0]], dtype=np.float32)
+    # The bands (possibly the read-only cache memmaps) are passed as they are, each tile is cast to float32 by the
+    # solver; the result goes to a file-backed memmap next to the output, outside the worker's data segment limit.
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output_path)), suffix='.npy') as tmp:
+        Z = np.lib.format.open_memmap(tmp.name, mode='w+', dtype=np.float32, shape=ms.shape)
+        # scenes already run in parallel processes, so each scene solves its tiles sequentially
+        bayesian_op.optimize_map_sar_tiled(ms, pan, lambdas=lambdas, workers=1, memory_budget_mb=memory_budget_mb, out=Z)
+        write_bands(output_path, Z, pan_meta)
+        del Z
+
+RUNNERS = {'gs': run_gs, 'hpf': run_hpf, 'map-sar': run_map_sar}
+
+def preview_map_sar(ms_paths, pan_path, factor):
+    bayesian_op = load_bayesian_ops()
+    ms, ms_meta, pan, pan_meta = read_preview(ms_paths, pan_path, factor)
+    lambdas = np.array(MAP_SAR_LAMBDAS[:ms.shape[0]], dtype=np.float32)
+    return bayesian_op.optimize_map_sar_tiled(upsample_preview(ms, ms_meta, pan_meta), pan.astype(np.float32),
+                                              lambdas=lambdas, workers=1)
+
+PREVIEWS = {'gs': preview_gs, 'hpf': preview_hpf, 'map-sar': preview_map_sar}
+
+def run_preview(scene_dir, method, output_path, factor):
+    """Pansharpens a scene decimated by factor with the given method and writes its RGB thumbnail (src/preview.py)."""
+    bands = find_band_files(scene_dir)
+    if bands is None:
+        raise FileNotFoundError(f"Required bands not found in {scene_dir}")
+    write_thumbnail(output_path, PREVIEWS[method](ms_band_paths(bands), bands['B8'][0], factor))
+
+def scene_metrics(scene_dir, output_path):
+    """
+    Metrics of a sharpened scene brought back to the MS grid against the original MS bands, and its no-reference
+    QNR at full resolution, as JSON-ready values.
+    """
+    bands = find_band_files(scene_dir)
+    metrics = evaluate_at_ms_resolution(output_path, ms_band_paths(bands))
+    metrics.update(qnr_rasters(output_path, ms_band_paths(bands), bands['B8'][0]))
+    return {name: np.asarray(value).tolist() for name, value in metrics.items()}
+
+def process_scene(scene_dir, method, output_dir, memory_budget_mb=None, cache_dir=None, evaluate=False, profile=False,
+                  preview=None):
+    """
+    Pansharpens one scene, or renders its quick-look thumbnail at 1/preview resolution when preview is given.
+    Never raises: the outcome is returned as a record for the batch report.
+    Returns:
+        dict: scene, method, status ('ok' or 'failed'), seconds, output and error (and metrics if evaluate,
+              per-stage resource usage if profile).
+    """
+    if _started_scenes is not None:
+        _started_scenes.put(scene_dir)
+    name = os.path.basename(os.path.normpath(scene_dir))
+    output_path = os.path.join(output_dir, f"{name}_{method}_preview.png" if preview else f"{name}_{method}.tif")
+    record = {'scene': scene_dir, 'method': method, 'output': output_path, 'error': None}
+    profiler = Profiler(enabled=profile)
+    start = time.perf_counter()
+    try:
+        if preview:
+            with profiler.stage(f"{method} preview"):
+                run_preview(scene_dir, method, output_path, preview)
+        else:
+            with profiler.stage(method):
+                RUNNERS[method](scene_dir, output_path, memory_budget_mb, cache_dir)
+        if evaluate:
+            with profiler.stage('evaluate'):
+                record['metrics'] = scene_metrics(scene_dir, output_path)
+        record['status'] = 'ok'
+    except Exception as e: # MemoryError from the worker limit included
+        record['status'] = 'failed'
+        record['output'] = None
+        record['error'] = f"{type(e).__name__}: {e}"
+        record['traceback'] = traceback.format_exc()
+    record['seconds'] = time.perf_counter() - start
+    if profile:
+        record['profile'] = profiler.stages
+    return record
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch pansharpening of Landsat 8 scenes.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--scenes", help="directory whose sub-folders are scenes")
+    source.add_argument("--manifest", help="text file listing one scene folder per line")
+    parser.add_argument("--method", choices=METHODS, default='gs', help="pansharpening method")
+    parser.add_argument("--output", default="sharpened", help="output directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="memory budget per worker in MB (sizes the tiles and caps the worker's heap)")
+    parser.add_argument("--evaluate", action="store_true",
+                        help="add quality metrics against the original MS bands to the report (same metrics for every method)")
+    parser.add_argument("--profile", action="store_true",
+                        help="add wall time, CPU time, peak RSS and allocations of each stage to the report")
+    parser.add_argument("--cache-dir", help="cache the decoded and resampled bands as .npy memmaps in this folder (map-sar)")
+    parser.add_argument("--preview", type=int, default=None, metavar="FACTOR",
+                        help="only write an RGB thumbnail of each scene pansharpened at 1/FACTOR resolution (read from overviews when available)")
+    args = parser.parse_args()
+    if args.preview is not None and args.preview < 1:
+        parser.error("--preview must be a positive decimation factor")
+    if args.preview and args.evaluate:
+        parser.error("--evaluate needs the full-resolution products, it cannot be combined with --preview")
+    return args
+
+def log_record(record):
+    if record['status'] == 'ok':
+        logger.info("[ok] %s (%.1f s)", record['scene'], record['seconds'])
+    else:
+        logger.error("[failed] %s: %s", record['scene'], record['error'])
+
+def worker_died_record(scene, method):
+    """Record of a scene whose worker process died (e.g. killed by the OS when out of memory)."""
+    return {'scene': scene, 'method': method, 'status': 'failed', 'seconds': None, 'output': None,
+            'error': "BrokenProcessPool: the worker process running this scene died (e.g. killed by the OS when out of memory)"}
+
+def run_pool(scenes, args, workers):
+    """
+    Runs scenes in a fresh process pool.
+    A worker killed by the OS breaks the whole pool and fails every unfinished future, not only its own scene, so
+    the scenes the pool did not finish are returned separately: those that had started when the pool broke (the
+    workers report each scene they start) and those that had not.
+    Returns:
+        tuple: (records of the finished scenes, unfinished scenes that had started, scenes that had not)
+    """
+    context = multiprocessing.get_context('spawn')
+    started_scenes = context.SimpleQueue()
+    records, unfinished = [], []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(args.memory_budget, started_scenes)) as executor:
+        futures = {executor.submit(process_scene, scene, args.method, args.output, args.memory_budget, args.cache_dir,
+                                   args.evaluate, args.profile, args.preview): scene for scene in scenes}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                unfinished.append(futures[future])
+                continue
+            except Exception as e: # e.g. the arguments or the record could not be pickled
+                record = {'scene': futures[future], 'method': args.method, 'status': 'failed',
+                          'seconds': None, 'output': None, 'error': f"{type(e).__name__}: {e}"}
+            records.append(record)
+            log_record(record)
+    started = set()
+    while not started_scenes.empty():
+        started.add(started_scenes.get())
+    return records, [s for s in unfinished if s in started], [s for s in unfinished if s not in started]
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    scenes = discover_scenes(args.scenes, args.manifest)
+    os.makedirs(args.output, exist_ok=True)
+    logger.info("Processing %d scenes with method %s on %d workers", len(scenes), args.method, args.workers)
+
+    records = []
+    start = time.perf_counter()
+    pending = scenes
+    while pending:
+        finished, running, pending = run_pool(pending, args, args.workers)
+        records += finished
+        if not running and pending:
+            # a worker died before reporting its scene: every unfinished scene is a suspect
+            running, pending = pending, []
+        died = running
+        if len(running) > 1:
+            # alone in its own pool, a scene whose worker dies again is the one that killed it
+            logger.warning("A worker died while %d scenes were running, running them again one at a time", len(running))
+            died = []
+            for scene in running:
+                finished, dead, not_started = run_pool([scene], args, 1)
+                records += finished
+                died += dead + not_started
+        for scene in died:
+            records.append(worker_died_record(scene, args.method))
+            log_record(records[-1])
+        # the scenes that had not started yet go to a fresh pool
+
+    failed = [r for r in records if r['status'] != 'ok']
+    report = {'method': args.method, 'workers': args.workers, 'memory_budget_mb': args.memory_budget,
+              'seconds': time.perf_counter() - start,
+              'succeeded': len(records) - len(failed), 'failed': len(failed), 'scenes': records}
+    report_path = os.path.join(args.output, 'batch_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("%d/%d scenes succeeded in %.1f s, report written to %s", report['succeeded'], len(records), report['seconds'], report_path)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
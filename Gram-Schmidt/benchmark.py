@@ -0,0 +1,215 @@
+"""
+Benchmarks of the pansharpening methods and of the evaluation on synthetic scenes (no USGS download needed).
+
+For each PAN size, a scene of 4 uint16 MS bands at half the PAN resolution is generated, upsampled once, and
+every benchmark is timed on it (best of --repeat runs). Throughput is reported in PAN megapixels per second,
+with the CPU time and peak memory of the run. Results are written as JSON tagged with the git commit, so runs on
+different commits can be compared with --compare.
+
+    python benchmark.py --sizes 1024 4096 --output benchmarks/latest.json
+    python benchmark.py --sizes 1024 4096 --compare benchmarks/previous.json
+    python benchmark.py --check-backends
+
+--check-backends compares the optional Numba kernels (src/kernels.py) with the NumPy reference implementation
+on synthetic data and exits with an error when they disagree (the same parity is tested in tests/test_kernels.py).
+"""
+from src.band_operations import match_histograms
+from src.evaluation import evaluate_pansharpening
+from src.gram_schmidt import pansharpen_gs, pansharpen_gs_fused
+from src.high_pass import pansharpen_hpf, pansharpen_hpf_fused
+from src.metrics import band_ssim, compute_metrics, compute_qnr, spectral_angle_map
+from src.kernels import HAVE_NUMBA
+from src.profiling import Profiler
+from batch import MAP_SAR_LAMBDAS, load_bayesian_ops
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+import cv2
+import numpy as np
+
+def synthetic_scene(size, nb_bands=4, ratio=2, seed=0, chunk_rows=1024):
+    """
+    Synthetic Landsat-like scene: a textured uint16 PAN band of size x size pixels and nb_bands uint16 MS bands
+    ratio times coarser, each a block average of the PAN texture with its own gain, offset and noise.
+    Generated in chunks of rows in float32 so that large sizes do not need float64 full-size temporaries.
+    Returns:
+        tuple: (ms (nb_bands, size // ratio, size // ratio), pan (size, size))
+    """
+    rng = np.random.default_rng(seed)
+    pan = np.empty((size, size), dtype=np.uint16)
+    ms = np.empty((nb_bands, size // ratio, size // ratio), dtype=np.uint16)
+    x = np.arange(size, dtype=np.float32)
+    chunk_rows -= chunk_rows % ratio
+    for row in range(0, size, chunk_rows):
+        y = np.arange(row, min(row + chunk_rows, size), dtype=np.float32)[:, None]
+        base = 8000 + 3000 * np.sin(x / 17.0) * np.cos(y / 23.0) + 1500 * np.sin((x + 2 * y) / 97.0)
+        base += rng.normal(0, 300, base.shape).astype(np.float32)
+        pan[row:row + len(y)] = np.clip(base, 0, 65535)
+        rows = len(y) // ratio
+        blocks = base[:rows * ratio, :ms.shape[2] * ratio].reshape(rows, ratio, ms.shape[2], ratio).mean(axis=(1, 3))
+        for k in range(nb_bands):
+            band = blocks * (0.6 + 0.2 * k) + 500 * k + rng.normal(0, 200, blocks.shape).astype(np.float32)
+            ms[k, row // ratio:row // ratio + rows] = np.clip(band, 0, 65535)
+    return ms, pan
+
+def upsample(ms, shape):
+    """Bilinear upsampling of every band to the PAN grid, in float32."""
+    return np.stack([cv2.resize(band.astype(np.float32), (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR) for band in ms])
+
+def git_commit():
+    """Commit hash of the working tree (with a '-dirty' suffix when there are local changes), or None outside git."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def benchmarks(ms, pan, ms_up, map_sar_size, bayesian_op):
+    """Benchmarks as (name, number of PAN pixels processed, function)."""
+    n_pixels = pan.size
+    ratio = pan.shape[0] / ms.shape[1]
+    sharpened = pansharpen_gs(ms_up, pan)
+    downsampled = np.stack([cv2.resize(band, (ms.shape[2], ms.shape[1]), interpolation=cv2.INTER_AREA) for band in sharpened])
+    pan_low = cv2.resize(pan, (ms.shape[2], ms.shape[1]), interpolation=cv2.INTER_AREA)
+    crop = min(map_sar_size, pan.shape[0])
+    lambdas = np.array(MAP_SAR_LAMBDAS[:ms.shape[0]], dtype=np.float32)
+    return [
+        ('pansharpen_gs', n_pixels, lambda: pansharpen_gs(ms_up, pan)),
+        ('pansharpen_hpf', n_pixels, lambda: pansharpen_hpf(ms_up, pan)),
+        # the fused kernels start from the MS bands at MS resolution, the upsampling is part of the timing
+        ('pansharpen_gs_fused', n_pixels, lambda: pansharpen_gs_fused(ms, pan)),
+        ('pansharpen_hpf_fused', n_pixels, lambda: pansharpen_hpf_fused(ms, pan)),
+        (f'optimize_map_sar_gd ({crop}x{crop} crop)', crop * crop,
+         lambda: bayesian_op.optimize_map_sar_gd(ms_up[:, :crop, :crop], pan[:crop, :crop].astype(np.float32), lambdas, verbose=False)),
+        ('match_histograms', downsampled[0].size, lambda: match_histograms(downsampled, ms, strength=0.3)),
+        ('evaluate_pansharpening', downsampled[0].size, lambda: evaluate_pansharpening(downsampled, ms, ratio)),
+        ('compute_metrics', downsampled[0].size, lambda: compute_metrics(ms, downsampled, ratio)),
+        ('band_ssim', downsampled[0].size, lambda: band_ssim(ms, downsampled, 65535.0)),
+        ('compute_qnr', n_pixels, lambda: compute_qnr(sharpened, ms, pan, pan_low)),
+    ] + ([
+        ('pansharpen_gs (numba)', n_pixels, lambda: pansharpen_gs(ms_up, pan, backend='numba')),
+        ('compute_metrics (numba)', downsampled[0].size, lambda: compute_metrics(ms, downsampled, ratio, backend='numba')),
+        ('spectral_angle_map', downsampled[0].size, lambda: spectral_angle_map(ms, downsampled)),
+        ('spectral_angle_map (numba)', downsampled[0].size, lambda: spectral_angle_map(ms, downsampled, backend='numba')),
+    ] if HAVE_NUMBA else [])
+
+def check_backends(size=512, nb_bands=4):
+    """
+    Parity of the Numba kernels with the NumPy reference on a synthetic scene, for uint16 and float32 inputs,
+    in place and not. Returns the list of (check, maximum difference, tolerance, passed).
+    """
+    ms, pan = synthetic_scene(size, nb_bands)
+    ms_up = upsample(ms, pan.shape)
+    ms_up_int = np.clip(np.rint(ms_up), 0, 65535).astype(np.uint16)
+    sharpened = pansharpen_gs(ms_up, pan)
+    layout_hwc = (np.ascontiguousarray(ms_up.transpose(1, 2, 0)), np.ascontiguousarray(sharpened.transpose(1, 2, 0)))
+    in_place = ms_up.copy()
+    pansharpen_gs(in_place, pan, out=in_place, backend='numba')
+    checks = [
+        # the injection kernel performs the same float32 operations in the same order: the results are bit-identical
+        ('pansharpen_gs float32', np.abs(pansharpen_gs(ms_up, pan, backend='numba') - sharpened).max(), 0.0),
+        ('pansharpen_gs uint16', np.abs(pansharpen_gs(ms_up_int, pan, backend='numba') - pansharpen_gs(ms_up_int, pan)).max(), 0.0),
+        ('pansharpen_gs in place', np.abs(in_place - sharpened).max(), 0.0),
+        ('pansharpen_gs_fused', np.abs(pansharpen_gs_fused(ms, pan, backend='numba') - pansharpen_gs_fused(ms, pan)).max(), 0.0),
+        # angles in radians: near 0, arccos of a float32 cosine is only accurate to about sqrt(float32 eps) ~ 3e-4,
+        # whatever the summation order (the NumPy code itself differs by that much between the two layouts)
+        ('spectral_angle_map chw', np.abs(spectral_angle_map(ms_up, sharpened, backend='numba') - spectral_angle_map(ms_up, sharpened)).max(), 2e-3),
+        ('spectral_angle_map hwc', np.abs(spectral_angle_map(*layout_hwc, layout='hwc', backend='numba') - spectral_angle_map(*layout_hwc, layout='hwc')).max(), 2e-3),
+        ('spectral_angle_map uint16', np.abs(spectral_angle_map(ms_up_int, ms_up, backend='numba') - spectral_angle_map(ms_up_int, ms_up)).max(), 2e-3),
+        ('compute_metrics SAM', abs(compute_metrics(ms_up, sharpened, backend='numba')['SAM (radians)'] - compute_metrics(ms_up, sharpened)['SAM (radians)']), 1e-5),
+    ]
+    return [(name, float(diff), tol, bool(diff <= tol)) for name, diff, tol in checks]
+
+def run_profiled(function, trace_allocations):
+    """One run of function under a Profiler stage, with the progress prints silenced. Returns the stage record."""
+    profiler = Profiler(enabled=True, trace_allocations=trace_allocations)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with profiler.stage('run'):
+                function()
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return profiler.stages[-1]
+
+def run_benchmark(function, repeat):
+    """
+    Best wall time of `repeat` runs, with the CPU time and peak RSS of that run. The timed runs do not trace
+    allocations (tracemalloc slows down allocation-heavy code the most); the peak bytes allocated come from one
+    extra traced run.
+    """
+    best = None
+    for _ in range(repeat):
+        record = run_profiled(function, trace_allocations=False)
+        if best is None or record['wall_seconds'] < best['wall_seconds']:
+            best = record
+    best['peak_allocated_mb'] = run_profiled(function, trace_allocations=True)['peak_allocated_mb']
+    return best
+
+def compare(results, previous_path):
+    """Prints the speed-up of every benchmark against a previous results file."""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    before = {(r['benchmark'], r['size']): r for r in previous['results']}
+    print(f"\nCompared with {previous.get('commit')}:")
+    for r in results:
+        old = before.get((r['benchmark'], r['size']))
+        if old:
+            print(f"{r['benchmark']:<44} {r['size']:>6} {old['seconds'] / r['seconds']:>8.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pansharpening methods and the evaluation on synthetic scenes.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1024, 2048], help="PAN sizes (square side in pixels)")
+    parser.add_argument("--bands", type=int, default=4, help="number of MS bands")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one is kept")
+    parser.add_argument("--map-sar-size", type=int, default=1024, help="side of the crop MAP-SAR is benchmarked on")
+    parser.add_argument("--output", default="benchmarks/latest.json", help="JSON file to write the results to (benchmarks/ is gitignored)")
+    parser.add_argument("--compare", metavar="PREVIOUS", help="results file of a previous run to compare with")
+    parser.add_argument("--check-backends", action="store_true",
+                        help="only check that the Numba kernels match the NumPy reference, exit with an error if not")
+    args = parser.parse_args()
+
+    if args.check_backends:
+        if not HAVE_NUMBA:
+            sys.exit("Numba is not installed, only the NumPy backend is available.")
+        results = check_backends()
+        for name, diff, tol, passed in results:
+            print(f"{name:<30} max difference {diff:.3e} (tolerance {tol:.0e}) {'ok' if passed else 'FAILED'}")
+        sys.exit(0 if all(passed for *_, passed in results) else 1)
+
+    bayesian_op = load_bayesian_ops()
+    results = []
+    print(f"{'benchmark':<44} {'size':>6} {'time (s)':>10} {'MP/s':>10} {'peak MB':>10}")
+    for size in args.sizes:
+        ms, pan = synthetic_scene(size, args.bands)
+        ms_up = upsample(ms, pan.shape)
+        for name, n_pixels, function in benchmarks(ms, pan, ms_up, args.map_sar_size, bayesian_op):
+            record = run_benchmark(function, args.repeat)
+            result = {'benchmark': name, 'size': size, 'megapixels': n_pixels / 1e6, 'seconds': record['wall_seconds'],
+                      'cpu_seconds': record['cpu_seconds'], 'mp_per_s': n_pixels / 1e6 / record['wall_seconds'],
+                      'peak_allocated_mb': record['peak_allocated_mb'], 'peak_rss_mb': record['peak_rss_mb']}
+            results.append(result)
+            print(f"{name:<44} {size:>6} {result['seconds']:>10.3f} {result['mp_per_s']:>10.2f} {result['peak_allocated_mb']:>10.1f}")
+
+    report = {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                          'cpu_count': os.cpu_count()},
+              'settings': vars(args), 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
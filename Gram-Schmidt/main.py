@@ -1,7 +1,15 @@
-from src.band_operations import read_band, resample_band, load_bands, resample_ms_to_pan, downsample_image, match_histograms
-from src.gram_schmidt import pansharpen_gs
+from src.band_operations import read_band, resample_band, load_bands, resample_ms_to_pan, downsample_image, match_histograms, find_band_files, ms_band_paths, wald_degrade, write_bands
+from src.gram_schmidt import pansharpen_gs, pansharpen_gs_fused
+from src.tiling import pansharpen_gs_tiled
+from src.raster_io import BLOCK_SIZE
+from src.band_cache import BandCache, cached_load_bands
+import argparse
+import logging
 import numpy as np
 from src.evaluation import evaluate_pansharpening, print_metrics, evaluate_and_save_pansharpening
+from src.metrics import compute_qnr
+from src.profiling import PROFILER
+from src.kernels import BACKENDS
 
 def print_image_stats(image, name, is_3d=False):
     print(f"\n{name}:")
@@ -12,10 +20,79 @@ def print_image_stats(image, name, is_3d=False):
     else:
         print(f"Min: {np.min(image):.2f}, Max: {np.max(image):.2f}, Mean: {np.mean(image):.2f}")
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gram-Schmidt pansharpening of a Landsat 8 scene.")
+    parser.add_argument("--data", default="data", help="folder containing the band GeoTIFFs")
+    parser.add_argument("--tiled", metavar="OUTPUT",
+                        help="stream the full scene tile by tile and write the sharpened GeoTIFF to OUTPUT "
+                             "(no in-memory evaluation run)")
+    parser.add_argument("--output", metavar="PATH",
+                        help="write the sharpened image to PATH as a tiled, cloud-optimised GeoTIFF on the PAN grid")
+    parser.add_argument("--reduced", action="store_true",
+                        help="Wald protocol: pansharpen MS and PAN degraded by the resolution ratio and compare with the original MS")
+    parser.add_argument("--tile-size", type=int, default=1024,
+                        help=f"tile side in PAN pixels for --tiled (multiple of {BLOCK_SIZE}, the output block size)")
+    parser.add_argument("--fused", action="store_true",
+                        help="upsample the MS bands on the fly inside the pansharpening instead of building the upsampled stack")
+    parser.add_argument("--backend", choices=BACKENDS, default='numpy',
+                        help="per-pixel kernels of the GS injection and SAM: NumPy (reference), Numba, or Numba when installed")
+    parser.add_argument("--cache-dir", help="cache the decoded and resampled bands as .npy memmaps in this folder")
+    parser.add_argument("--cache-size", type=float, default=20, metavar="GB", help="maximum size of the band cache")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LEFT", "BOTTOM", "RIGHT", "TOP"),
+                        help="only process this region of interest, in the map coordinates of the scene")
+    parser.add_argument("--overview-level", type=int, default=None,
+                        help="read the bands from this overview level (0 is the first overview) for quick looks")
+    parser.add_argument("--resample-workers", type=int, default=None,
+                        help="number of MS bands resampled concurrently (default: one per band, up to the CPU count)")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="record wall time, CPU time, peak RSS and allocations of every stage into the JSON file REPORT")
+    parser.add_argument("--verbose", action="store_true", help="log per-band diagnostics (costs extra passes over the data)")
+    args = parser.parse_args()
+    if args.tile_size <= 0 or args.tile_size % BLOCK_SIZE != 0:
+        parser.error(f"--tile-size must be a positive multiple of {BLOCK_SIZE}")
+    return args
+
+def run_tiled(data_folder, output_path, tile_size, backend='numpy'):
+    bands = find_band_files(data_folder)
+    if bands is None:
+        print("Failed to find bands.")
+        return
+    with PROFILER.stage("pansharpen_gs_tiled"):
+        pansharpen_gs_tiled(ms_band_paths(bands), bands['B8'][0], output_path, tile_size=tile_size, backend=backend)
+
+def run_reduced(data_folder, resample_workers=None, bounds=None, overview_level=None, backend='numpy'):
+    with PROFILER.stage("load_bands"):
+        loaded = load_bands(data_folder, bounds=bounds, overview_level=overview_level)
+    if loaded is None:
+        print("Failed to load bands.")
+        return
+    ms_list, ms_meta_list, pan, pan_meta = loaded
+    with PROFILER.stage("wald_degrade"):
+        ms_low, ms_low_meta, pan_low, pan_low_meta = wald_degrade(ms_list, ms_meta_list, pan, pan_meta)
+    with PROFILER.stage("resample_ms_to_pan"):
+        resampled_ms_array = resample_ms_to_pan(ms_low, ms_low_meta, pan_low.shape, pan_low_meta, workers=resample_workers)
+    with PROFILER.stage("pansharpen_gs"):
+        sharpened_ms = pansharpen_gs(resampled_ms_array, pan_low, backend=backend)
+
+    # The sharpened image is already on the original MS grid: no downsampling before the evaluation
+    ratio = (pan.shape[0] / ms_list[0].shape[0] + pan.shape[1] / ms_list[0].shape[1]) / 2
+    with PROFILER.stage("evaluate_pansharpening"):
+        evaluate_and_save_pansharpening(sharpened_ms, np.array(ms_list), ratio=ratio,
+                                        filename='pansharpening_results_reduced.txt', backend=backend)
+
+def run_full(args):
     # Test load_bands function
     print("\nTesting load_bands function:")
-    ms_list, ms_meta_list, pan, pan_meta = load_bands("data")
+    resampled_ms_array = None
+    with PROFILER.stage("load_bands"):
+        if args.cache_dir:
+            cache = BandCache(args.cache_dir, max_bytes=int(args.cache_size * 2**30))
+            loaded = cached_load_bands(args.data, cache, workers=args.resample_workers,
+                                       bounds=args.bbox, overview_level=args.overview_level)
+            ms_list, ms_meta_list, resampled_ms_array, pan, pan_meta = loaded if loaded else (None,) * 5
+        else:
+            loaded = load_bands(args.data, bounds=args.bbox, overview_level=args.overview_level)
+            ms_list, ms_meta_list, pan, pan_meta = loaded if loaded else (None,) * 4
     
     if ms_list is None:
         print("Failed to load bands.")
@@ -37,30 +114,45 @@ def main():
     # original MS shape 
     original_ms_shape = ms_list[0].shape
     
-    # Testing resampling using resample_ms_to_pan function
-    print("\nTesting resampling using resample_ms_to_pan function:")
-    resampled_ms_array = resample_ms_to_pan(ms_list, ms_meta_list, pan.shape, pan_meta)
-    
-    # Print shapes of resampled bands
-    for i in range(resampled_ms_array.shape[0]):
-        print(f"Resampled multispectral band {i+1} shape: {resampled_ms_array[i].shape}")
-    
-    # Print statistics after resampling
-    print_image_stats(resampled_ms_array, "After resampling", is_3d=True)
-    
-    # Test Gram-Schmidt pansharpening
-    print("\nTesting Gram-Schmidt pansharpening:")
-    sharpened_ms = pansharpen_gs(resampled_ms_array, pan)
+    if args.fused:
+        # Upsampling fused into the sharpening: the MS stack is only ever held at MS resolution
+        print("\nTesting fused upsampling and Gram-Schmidt pansharpening:")
+        with PROFILER.stage("pansharpen_gs_fused"):
+            sharpened_ms = pansharpen_gs_fused(np.array(ms_list), pan, ms_meta_list[0]['transform'], pan_meta['transform'],
+                                               backend=args.backend)
+    else:
+        # Testing resampling using resample_ms_to_pan function
+        print("\nTesting resampling using resample_ms_to_pan function:")
+        if resampled_ms_array is None:
+            with PROFILER.stage("resample_ms_to_pan"):
+                resampled_ms_array = resample_ms_to_pan(ms_list, ms_meta_list, pan.shape, pan_meta, workers=args.resample_workers)
+
+        # Print shapes of resampled bands
+        for i in range(resampled_ms_array.shape[0]):
+            print(f"Resampled multispectral band {i+1} shape: {resampled_ms_array[i].shape}")
+
+        # Print statistics after resampling
+        print_image_stats(resampled_ms_array, "After resampling", is_3d=True)
+
+        # Test Gram-Schmidt pansharpening
+        print("\nTesting Gram-Schmidt pansharpening:")
+        with PROFILER.stage("pansharpen_gs"):
+            sharpened_ms = pansharpen_gs(resampled_ms_array, pan, backend=args.backend)
     print(f"Sharpened multispectral image shape: {sharpened_ms.shape}")
+    if args.output:
+        with PROFILER.stage("write_bands"):
+            write_bands(args.output, sharpened_ms, pan_meta)
+        print(f"Sharpened image written to {args.output}")
     
     # Print statistics after pansharpening
     print_image_stats(sharpened_ms, "After pansharpening", is_3d=True)
     
     # Downsample the sharpened image 
     print("\nDownsampling the sharpened image to original MS resolution:")
-    downsampled_sharpened = np.zeros((sharpened_ms.shape[0], original_ms_shape[0], original_ms_shape[1]))
-    for i in range(sharpened_ms.shape[0]):
-        downsampled_sharpened[i] = downsample_image(sharpened_ms[i], original_ms_shape)
+    with PROFILER.stage("downsample_image"):
+        downsampled_sharpened = np.zeros((sharpened_ms.shape[0], original_ms_shape[0], original_ms_shape[1]))
+        for i in range(sharpened_ms.shape[0]):
+            downsampled_sharpened[i] = downsample_image(sharpened_ms[i], original_ms_shape)
     print(f"Original sharpened shape: {sharpened_ms.shape}")
     print(f"Downsampled sharpened shape: {downsampled_sharpened.shape}")
     
@@ -70,10 +162,17 @@ def main():
     # Create original MS array for evaluation
     original_ms_array = np.array(ms_list)
     
+    # No-reference quality of the full resolution product
+    print("\nComputing QNR at full resolution:")
+    with PROFILER.stage("compute_qnr"):
+        qnr = compute_qnr(sharpened_ms, original_ms_array, pan, downsample_image(pan, original_ms_shape))
+    print(f"D_lambda: {qnr['D_lambda']:.4f}, D_s: {qnr['D_s']:.4f}, QNR: {qnr['QNR']:.4f}")
+    
     
     # Apply histogram matching before evaluation with a gentle strength
     print("\nApplying gentle histogram matching to align intensity distributions...")
-    downsampled_sharpened_matched = match_histograms(downsampled_sharpened, original_ms_array, strength=0.3)
+    with PROFILER.stage("match_histograms"):
+        downsampled_sharpened_matched = match_histograms(downsampled_sharpened, original_ms_array, strength=0.3)
     
     # Evaluate the pansharpening results at original MS resolution
     print("\nEvaluating pansharpening results:")
@@ -87,12 +186,32 @@ def main():
     print("\nRunning evaluation and saving results to file:")
     # Evaluate both with and without histogram matching
     print("\nEvaluating without histogram matching:")
-    evaluate_and_save_pansharpening(downsampled_sharpened, original_ms_array, ratio=ratio, 
-                                   filename='pansharpening_results_no_matching.txt')
+    with PROFILER.stage("evaluate_pansharpening"):
+        evaluate_and_save_pansharpening(downsampled_sharpened, original_ms_array, ratio=ratio, 
+                                       filename='pansharpening_results_no_matching.txt', backend=args.backend)
     
     print("\nEvaluating with histogram matching:")
-    evaluate_and_save_pansharpening(downsampled_sharpened_matched, original_ms_array, ratio=ratio,
-                                   filename='pansharpening_results.txt')
+    with PROFILER.stage("evaluate_pansharpening_matched"):
+        evaluate_and_save_pansharpening(downsampled_sharpened_matched, original_ms_array, ratio=ratio,
+                                       filename='pansharpening_results.txt', backend=args.backend)
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.verbose:
+        logging.getLogger("src").setLevel(logging.DEBUG)
+    if args.profile:
+        PROFILER.enable()
+    try:
+        if args.tiled:
+            run_tiled(args.data, args.tiled, args.tile_size, args.backend)
+        elif args.reduced:
+            run_reduced(args.data, args.resample_workers, args.bbox, args.overview_level, args.backend)
+        else:
+            run_full(args)
+    finally:
+        if args.profile:
+            PROFILER.write_report(args.profile, args=vars(args))
    
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+from .band_operations import find_band_files, ms_band_paths, read_band, resample_ms_to_pan
+from .raster_io import aligned_bounds, bounds_window, open_band
+
+logger = logging.getLogger(__name__)
+
+class BandCache:
+    """
+    On-disk cache of decoded and resampled bands, stored as raw .npy files.
+
+    Entries are keyed by the source files (absolute path, size and modification time) and the processing
+    parameters, so any change to an input invalidates them. Hits are opened zero-copy with
+    np.load(mmap_mode='r'). The directory is kept under max_bytes by evicting the least recently used
+    entries (last use is tracked through the file modification time).
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def source_key(filepath):
+        stat = os.stat(filepath)
+        return [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]
+
+    def key(self, sources, params):
+        """Cache key of the result of processing `sources` (file paths) with `params` (JSON-serialisable dict)."""
+        payload = json.dumps({'sources': [self.source_key(f) for f in sources], 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """Returns the cached array as a read-only memmap, or None on a miss."""
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        os.utime(path) # mark as recently used
+        return array
+
+    def _write(self, key, shape, dtype, fill):
+        """Writes an entry through fill(memmap), atomically so concurrent workers never see partial files."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        stored = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=tuple(shape))
+        try:
+            fill(stored)
+            stored.flush()
+        except BaseException:
+            del stored
+            os.remove(tmp_path)
+            raise
+        del stored
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, array):
+        """Stores an array and returns it as a memmap."""
+        def fill(stored):
+            stored[...] = array
+        return self._write(key, array.shape, array.dtype, fill)
+
+    def fetch(self, sources, params, compute, shape=None, dtype=None):
+        """
+        Returns the cached result for (sources, params), computing and storing it on a miss.
+        Without shape, compute() returns the array to store. With shape and dtype, compute(out) writes the result
+        directly into the memmap of the new entry, so it is never held in memory.
+        """
+        key = self.key(sources, params)
+        array = self.get(key)
+        if array is not None:
+            logger.info("Cache hit for %s (%s)", params.get('op'), key[:12])
+            return array
+        logger.info("Cache miss for %s (%s), computing...", params.get('op'), key[:12])
+        if shape is None:
+            return self.put(key, compute())
+        return self._write(key, shape, dtype, compute)
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries until the cache fits in max_bytes (never deletes `keep`)."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # evicted by another worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path) # processes that mapped it keep a valid mapping
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info("Evicted %s from the band cache", os.path.basename(path))
+
+
+def cached_read_band(filepath, cache, bounds=None, overview_level=None):
+    """read_band through the cache: the pixels come from a memmap, the metadata from the file header."""
+    with open_band(filepath, overview_level) as src:
+        meta = src.meta.copy()
+        if bounds is not None:
+            window = bounds_window(src, bounds)
+            meta.update(width=int(window.width), height=int(window.height), transform=src.window_transform(window))
+    params = {'op': 'read_band', 'bounds': bounds, 'overview_level': overview_level}
+    band = cache.fetch([filepath], params, lambda: read_band(filepath, bounds, overview_level)[0])
+    return band, meta
+
+def cached_load_bands(data_folder, cache, workers=None, bounds=None, overview_level=None):
+    """
+    Same as load_bands followed by resample_ms_to_pan, with both the decoded and the resampled bands cached.
+    On a miss the bands are resampled straight into the cache file.
+    Returns:
+        tuple: (ms_list, ms_meta_list, resampled MS stack (bands, H, W), pan, pan_meta), arrays as read-only memmaps.
+    """
+    bands = find_band_files(data_folder)
+    if bands is None:
+        return None
+    ms_paths = ms_band_paths(bands)
+    if bounds is not None:
+        with open_band(ms_paths[0], overview_level) as src:
+            bounds = aligned_bounds(bounds, src.transform)
+    ms_list, ms_meta_list = zip(*[cached_read_band(path, cache, bounds, overview_level) for path in ms_paths])
+    pan, pan_meta = cached_read_band(bands['B8'][0], cache, bounds, overview_level)
+    resampled = cache.fetch(ms_paths + [bands['B8'][0]],
+                            {'op': 'resample_ms_to_pan', 'resampling': 'bilinear', 'shape': list(pan.shape),
+                             'bounds': bounds, 'overview_level': overview_level},
+                            lambda out: resample_ms_to_pan(ms_list, ms_meta_list, pan.shape, pan_meta, out=out, workers=workers),
+                            shape=(len(ms_list),) + pan.shape, dtype=np.result_type(*ms_list))
+    return list(ms_list), list(ms_meta_list), resampled, pan, pan_meta
@@ -1,22 +1,27 @@
-import rasterio
 from rasterio.enums import Resampling
 from rasterio.warp import reproject
+from affine import Affine
 import numpy as np
 import glob
 import os
 import cv2
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-def read_band(filepath):
-    """Reads a single band from a raster file."""
-    print(f"Reading {filepath}")
-    with rasterio.open(filepath) as src:
-        band = src.read(1)  # reading the first band
-        print(f"Raw band data: {band}")
-        print(f"Band stats - Min: {np.min(band)}, Max: {np.max(band)}, Mean: {np.mean(band)}")
-        meta = src.meta
+from .raster_io import aligned_bounds, open_band, read_bands, read_window, write_bands
+from .statistics import BandHistograms
+
+logger = logging.getLogger(__name__)
+
+def read_band(filepath, bounds=None, overview_level=None):
+    """Reads a single band from a raster file (optionally a region in map coordinates, or an overview level)."""
+    logger.info("Reading %s", filepath)
+    band, meta = read_window(filepath, bounds=bounds, overview_level=overview_level)
+    if logger.isEnabledFor(logging.DEBUG): # full-band statistics are an extra pass, only pay for them when asked
+        logger.debug("Band stats - Min: %s, Max: %s, Mean: %s", np.min(band), np.max(band), np.mean(band))
     return band, meta
 
-def resample_band(band, src_meta, target_shape, target_transform, target_crs):
+def resample_band(band, src_meta, target_shape, target_transform, target_crs, out=None, num_threads=1, warp_mem_limit=0):
     """
     Resamples a band to the target shape using bilinear interpolation.
     Args:
@@ -25,10 +30,13 @@ def resample_band(band, src_meta, target_shape, target_transform, target_crs):
         target_shape (tuple): Desired shape (height, width) for the output band.
         target_transform (Affine): Affine transformation for the target band.
         target_crs (CRS): Coordinate reference system for the target band.
+        out (numpy.ndarray): Optional array of target_shape to write the result into (e.g. a slice of a stack or memmap).
+        num_threads (int): Number of GDAL warp threads.
+        warp_mem_limit (int): GDAL warp working memory in MB (0 for the GDAL default).
     Returns:
         numpy.ndarray: Resampled band.
     """
-    dst_band = np.empty(target_shape, dtype=band.dtype)
+    dst_band = np.empty(target_shape, dtype=band.dtype) if out is None else out
     reproject(
         source=band,
         destination=dst_band,
@@ -36,34 +44,55 @@ def resample_band(band, src_meta, target_shape, target_transform, target_crs):
         src_crs=src_meta['crs'],
         dst_transform=target_transform,
         dst_crs=target_crs,
-        resampling=Resampling.bilinear
+        resampling=Resampling.bilinear,
+        num_threads=num_threads,
+        warp_mem_limit=warp_mem_limit
     )
     return dst_band
 
-def resample_ms_to_pan(ms_list, ms_meta_list, pan_shape, pan_meta):
+def resample_ms_to_pan(ms_list, ms_meta_list, pan_shape, pan_meta, out=None, workers=None, num_threads=1, warp_mem_limit=0):
     """
     Resamples each multispectral band to the panchromatic resolution if needed.
+    The bands are resampled concurrently (GDAL releases the GIL while warping), each one straight into its slot
+    of the output stack, so no per-band array is copied into the stack afterwards.
     Args:
         ms_list (list): List of multispectral bands.
         ms_meta_list (list): List of metadata for each multispectral band.
         pan_shape (tuple): Shape of the panchromatic band.
         pan_meta (dict): Metadata of the panchromatic band.
+        out (numpy.ndarray): Optional (bands, H, W) array or memmap to write into (default: new array of the bands' dtype).
+        workers (int): Number of bands resampled at the same time (default: one per band, capped by the CPU count).
+        num_threads (int): GDAL warp threads per band.
+        warp_mem_limit (int): GDAL warp working memory per band in MB (0 for the GDAL default).
     Returns:
         numpy.ndarray: Array of resampled multispectral bands.
     """
-    resampled_ms = []
-    for i, (band, meta) in enumerate(zip(ms_list, ms_meta_list)):
-        if band.shape != pan_shape:
-            print(f"Resampling band {i+1} from shape {band.shape} to match panchromatic resolution {pan_shape}")
-            band_resampled = resample_band(band, meta, pan_shape, pan_meta['transform'], pan_meta['crs'])
+    if out is None:
+        out = np.empty((len(ms_list),) + tuple(pan_shape), dtype=np.result_type(*ms_list))
+
+    def resample(i):
+        band, meta = ms_list[i], ms_meta_list[i]
+        if band.shape != tuple(pan_shape):
+            logger.info("Resampling band %d from shape %s to match panchromatic resolution %s", i + 1, band.shape, pan_shape)
+            resample_band(band, meta, pan_shape, pan_meta['transform'], pan_meta['crs'], out=out[i],
+                          num_threads=num_threads, warp_mem_limit=warp_mem_limit)
         else:
-            band_resampled = band
-            print(f"Band {i+1} already matches panchromatic resolution")
-        resampled_ms.append(band_resampled)
-    return np.array(resampled_ms)
+            out[i] = band
+            logger.info("Band %d already matches panchromatic resolution", i + 1)
 
-def load_bands(data_folder):
-    """Loads multispectral and panchromatic bands from the given folder."""
+    workers = workers or min(len(ms_list), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(resample, range(len(ms_list)))) # re-raises the first error
+    return out
+
+def find_band_files(data_folder):
+    """Finds the Landsat band files in the given folder.
+    Args:
+        data_folder (str): Folder containing the band GeoTIFFs.
+    Returns:
+        dict: Mapping of band name ('B2', 'B3', 'B4', 'B5', 'B8') to the list of matching file paths,
+              or None if a required band is missing.
+    """
     all_tiff_files = glob.glob(os.path.join(data_folder, "*.tif")) + glob.glob(os.path.join(data_folder, "*.tiff"))
     
     # Identify bands
@@ -72,38 +101,62 @@ def load_bands(data_folder):
     }
     bands = {name: [f for f in all_tiff_files if identifier in f] for name, identifier in band_map.items()}
 
-    print(f"All TIFF files found: {all_tiff_files}")
-    print(f"Band mapping: {bands}")
-    print(f"Required bands: {'B2', 'B3', 'B4', 'B8'}")
+    logger.debug("All TIFF files found: %s", all_tiff_files)
+    logger.debug("Band mapping: %s", bands)
 
     # Ensure required bands exist
     required_bands = ['B2', 'B3', 'B4', 'B8']
     for band in required_bands:
         if not bands[band]:
-            print(f"ERROR: {band} band not found!")
+            logger.error("%s band not found in %s!", band, data_folder)
             return None
-    print("All required bands found.")
+    logger.info("All required bands found.")
+    return bands
+
+def ms_band_paths(bands):
+    """Returns the multispectral band paths (Blue, Green, Red and optional NIR) in stacking order."""
+    paths = [bands['B2'][0], bands['B3'][0], bands['B4'][0]]
+    if bands['B5']:
+        paths.append(bands['B5'][0])
+    return paths
 
-    # Read required bands
-    blue, blue_meta = read_band(bands['B2'][0])
-    green, green_meta = read_band(bands['B3'][0])
-    red, red_meta = read_band(bands['B4'][0])
-    pan, pan_meta = read_band(bands['B8'][0])
+def load_bands(data_folder, bounds=None, overview_level=None, workers=None):
+    """Loads multispectral and panchromatic bands from the given folder.
+    Args:
+        data_folder (str): Folder containing the band GeoTIFFs.
+        bounds (tuple): Optional region of interest (left, bottom, right, top) in the scene CRS. It is snapped to
+                        the MS pixel grid so that the MS and PAN windows cover the same ground area.
+        overview_level (int): Optional overview level to read instead of the full resolution.
+        workers (int): Number of bands read concurrently (default: one per band, up to the CPU count).
+    Returns:
+        tuple: (ms_list, ms_meta_list, pan, pan_meta), or None if a required band is missing.
+    """
+    bands = find_band_files(data_folder)
+    if bands is None:
+        return None
 
-    print(f"Blue band shape: {blue.shape}, Green band shape: {green.shape}, Red band shape: {red.shape}, Panchromatic band shape: {pan.shape}")
+    ms_paths = ms_band_paths(bands)
+    if bounds is not None:
+        with open_band(ms_paths[0], overview_level) as src:
+            bounds = aligned_bounds(bounds, src.transform)
+        logger.info("Region of interest aligned to the MS grid: %s", bounds)
 
-    ms_list = [blue, green, red]
-    ms_meta_list = [blue_meta, green_meta, red_meta]
-    band_names = ['Blue', 'Green', 'Red']
+    logger.info("Reading %s", ms_paths + [bands['B8'][0]])
+    band_list, meta_list = read_bands(ms_paths + [bands['B8'][0]], bounds=bounds, overview_level=overview_level, workers=workers)
+    ms_list, ms_meta_list = band_list[:-1], meta_list[:-1]
+    pan, pan_meta = band_list[-1], meta_list[-1]
+    if logger.isEnabledFor(logging.DEBUG):
+        for band in band_list:
+            logger.debug("Band stats - Min: %s, Max: %s, Mean: %s", np.min(band), np.max(band), np.mean(band))
 
+    logger.info("Blue band shape: %s, Green band shape: %s, Red band shape: %s, Panchromatic band shape: %s", ms_list[0].shape, ms_list[1].shape, ms_list[2].shape, pan.shape)
+
+    band_names = ['Blue', 'Green', 'Red']
     if bands['B5']:  # Optional NIR band
-        nir, nir_meta = read_band(bands['B5'][0])
-        ms_list.append(nir)
-        ms_meta_list.append(nir_meta)
         band_names.append('NIR')
-        print("NIR band loaded successfully.")
+        logger.info("NIR band loaded successfully.")
 
-    print("Loaded multispectral bands:", band_names)
+    logger.info("Loaded multispectral bands: %s", band_names)
     return ms_list, ms_meta_list, pan, pan_meta
 
 def downsample_image(image, target_shape):
@@ -117,51 +170,110 @@ def downsample_image(image, target_shape):
     # cv2.resize expects size as (width, height)
     return cv2.resize(image, (target_shape[1], target_shape[0]), interpolation=cv2.INTER_AREA) # resamples pixel values using area relations by averaging neighboring pixels
 
-def match_histograms(source, reference, strength=0.5):
+def degrade_band(band, meta, target_shape):
+    """
+    Degrades a band to a coarser grid covering the same extent (area averaging), for reduced-resolution runs.
+    Args:
+        band (numpy.ndarray): The input band.
+        meta (dict): Metadata of the band.
+        target_shape (tuple): Shape (height, width) of the degraded band.
+    Returns:
+        tuple: (degraded band, metadata with the transform, width and height of the coarser grid)
+    """
+    degraded = downsample_image(band, target_shape)
+    degraded_meta = dict(meta, height=target_shape[0], width=target_shape[1],
+                         transform=meta['transform'] * Affine.scale(band.shape[1] / target_shape[1], band.shape[0] / target_shape[0]))
+    return degraded, degraded_meta
+
+def wald_degrade(ms_list, ms_meta_list, pan, pan_meta):
+    """
+    Wald protocol: degrades the MS and PAN bands by the PAN/MS resolution ratio, so that pansharpening the
+    degraded inputs yields an image on the original MS grid that can be compared with the original MS bands.
+    Fusing and evaluating then involves ratio^2 (4 for Landsat 8) fewer pixels than the full-resolution run.
+    Returns:
+        tuple: (degraded ms_list, ms_meta_list, PAN degraded to the original MS grid, its metadata)
+    """
+    ms_shape = ms_list[0].shape
+    ratio = (pan.shape[0] / ms_shape[0], pan.shape[1] / ms_shape[1])
+    low_shape = (max(1, round(ms_shape[0] / ratio[0])), max(1, round(ms_shape[1] / ratio[1])))
+    logger.info("Reduced resolution run: MS %s -> %s, PAN %s -> %s", ms_shape, low_shape, pan.shape, ms_shape)
+    ms_low, ms_low_meta = zip(*[degrade_band(band, meta, low_shape) for band, meta in zip(ms_list, ms_meta_list)])
+    pan_low, pan_low_meta = degrade_band(pan, pan_meta, ms_shape)
+    return list(ms_low), list(ms_low_meta), pan_low, pan_low_meta
+
+def histogram_matching_luts(source_hist, reference_hist):
+    """
+    Lookup tables mapping every source bin to the reference value of the same rank.
+    Args:
+        source_hist (BandHistograms): Histograms of the image to modify.
+        reference_hist (BandHistograms): Histograms of the reference image (any grid).
+    Returns:
+        numpy.ndarray: Matched value of each source bin, shape (nb_bands, source_hist.bins).
+    """
+    source_cdf, reference_cdf = source_hist.cdf, reference_hist.cdf
+    reference_values = reference_hist.centers
+    luts = np.empty(source_cdf.shape, dtype=np.float64)
+    for i in range(source_cdf.shape[0]):
+        present = reference_hist.counts[i] > 0 # keeps the reference quantiles strictly increasing
+        luts[i] = np.interp(source_cdf[i], reference_cdf[i][present], reference_values[present])
+    return luts
+
+def apply_histogram_luts(source, source_hist, luts, strength=1.0, out=None):
+    """
+    Applies the lookup tables of histogram_matching_luts to an image or to a tile of it.
+    Exact (integer) histograms are looked up directly; quantised ones are interpolated linearly between
+    the bin centres so that float images are not posterised.
+    Args:
+        source (numpy.ndarray): Image or tile [nb_bands, h, w].
+        source_hist (BandHistograms): Histograms the LUTs were built from (defines the bins).
+        luts (numpy.ndarray): Output of histogram_matching_luts.
+        strength (float): 0.0 = no change, 1.0 = full histogram matching.
+        out (numpy.ndarray): Optional output array (same dtype as source for floats, float32 otherwise).
+    Returns:
+        numpy.ndarray: Matched image.
+    """
+    if out is None:
+        out = np.empty(source.shape, dtype=source.dtype if source.dtype.kind == 'f' else np.float32)
+    for i in range(source.shape[0]):
+        if source_hist.exact:
+            matched = luts[i][source_hist.bin_index(source[i])]
+        else:
+            position = (source[i] - source_hist.lo) * (1.0 / source_hist.width) - 0.5
+            np.clip(position, 0, source_hist.bins - 1, out=position)
+            index = np.minimum(position.astype(np.intp), source_hist.bins - 2)
+            lut = luts[i]
+            matched = lut[index] + (position - index) * (lut[index + 1] - lut[index])
+        if strength < 1.0:
+            matched = (1 - strength) * source[i] + strength * matched
+        out[i] = matched
+    return out
+
+def match_histograms(source, reference, strength=0.5, bins=4096):
     """Match the histogram of source to reference with a controllable strength parameter.
     
+    Each source pixel is mapped to the reference value with the same rank (computed from histograms, so the cost
+    is linear in the number of pixels). Integer images of up to 16 bits are matched exactly, float images are
+    quantised on `bins` bins. For tiled processing, accumulate BandHistograms over the tiles first, then call
+    histogram_matching_luts once and apply_histogram_luts on every tile.
+
     Args:
         source (numpy.ndarray): The source image to modify [nb_bands, h, w]
         reference (numpy.ndarray): The reference image [nb_bands, h, w]
         strength (float): Controls the strength of histogram matching (0.0 to 1.0)
                          0.0 = no change, 1.0 = full histogram matching
+        bins (int): Number of bins used to quantise float images.
         
     Returns:
         numpy.ndarray: Image with histogram matched to reference
     """
-    print(f"Matching histograms between source and reference images (strength={strength})...")
-    matched = np.zeros_like(source)
+    logger.info("Matching histograms between source and reference images (strength=%s)...", strength)
+    source_hist = BandHistograms.from_image(source, bins)
+    luts = histogram_matching_luts(source_hist, BandHistograms.from_image(reference, bins))
+    matched = apply_histogram_luts(source, source_hist, luts, strength)
     
-    for i in range(source.shape[0]):
-        # Sort the values of source and reference
-        source_values = source[i].flatten()
-        reference_values = reference[i].flatten()
-        
-        source_sorted = np.sort(source_values)
-        reference_sorted = np.sort(reference_values)
-        
-        # Create a mapping from source to reference
-        source_quantiles = np.linspace(0, 1, len(source_sorted))
-        reference_quantiles = np.linspace(0, 1, len(reference_sorted))
-        
-        # Interpolate reference values at source quantiles
-        interp_values = np.interp(source_quantiles, reference_quantiles, reference_sorted)
-        
-        # Create a lookup table
-        idx = np.argsort(source_sorted)
-        source_ranks = np.zeros_like(idx)
-        source_ranks[idx] = np.arange(len(source_sorted))
-        
-        # Apply the mapping with strength control
-        if strength < 1.0:
-            # Blend between original and matched values
-            matched_values = interp_values[source_ranks.reshape(source[i].shape)]
-            matched[i] = (1 - strength) * source[i] + strength * matched_values
-        else:
-            # Full histogram matching
-            matched[i] = interp_values[source_ranks.reshape(source[i].shape)]
-        
-        print(f"  - Band {i+1} histogram matched - Min: {np.min(matched[i]):.2f}, Max: {np.max(matched[i]):.2f}, Mean: {np.mean(matched[i]):.2f}")
+    if logger.isEnabledFor(logging.DEBUG):
+        for i in range(matched.shape[0]):
+            logger.debug("  - Band %d histogram matched - Min: %.2f, Max: %.2f, Mean: %.2f", i + 1, np.min(matched[i]), np.max(matched[i]), np.mean(matched[i]))
     
-    print("Histogram matching completed.")
-    return matched
\ No newline at end of file
+    logger.info("Histogram matching completed.")
+    return matched
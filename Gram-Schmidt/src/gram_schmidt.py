@@ -1,12 +1,22 @@
+import logging
 import numpy as np
 
-def pansharpen_gs(ms, pan, weights=None):
+from .kernels import gs_injection, resolve_backend
+from .statistics import JointMoments, gs_moments
+from .upsampling import bilinear_grid, upsample_rows
+
+logger = logging.getLogger(__name__)
+
+def pansharpen_gs(ms, pan, weights=None, chunk_rows=512, out=None, backend='numpy'):
     """
     Performs pansharpening using a Gram-Schmidt approach.
     
     ms: 3D numpy array of shape (bands, H, W) for multispectral data.
     pan: 2D numpy array (H, W) for the high-resolution panchromatic band.
     weights: List or array of weights to compute the synthetic pan; if None, weights are estimated from correlation.
+    chunk_rows: Number of rows per chunk in the statistics pass (bounds its temporaries).
+    out: Optional float32 array (bands, H, W) to write the result into; it may be ms itself when ms is float32.
+    backend: 'numpy' (reference), 'numba' (compiled injection, see src/kernels.py) or 'auto'.
 
     Note : MS and PAN should have the same shape (already upsampled)
 
@@ -17,85 +27,175 @@ def pansharpen_gs(ms, pan, weights=None):
     - Apply the Gram-Schmidt transformation
     """
 
-    print("Starting Gram-Schmidt pansharpening...")
-    
-    # If weights are not provided, estimate them based on correlation with PAN
+    logger.info("Starting Gram-Schmidt pansharpening...")
+
+    # Statistics stage: a single pass over the data gives the means and the band x band / band x PAN
+    # covariances, from which the weights, the synthetic pan statistics, the gains and the correlations all follow.
+    moments = gs_moments(ms, pan, chunk_rows=chunk_rows)
+    params = gs_parameters_from_moments(moments.mean, moments.covariance, weights)
+    logger.info("Weights used for synthetic panchromatic image: %s", params['weights'])
+    logger.debug("Panchromatic mean: %s, Panchromatic std: %s", params['pan_mean'], params['pan_std'])
+    logger.debug("Synthetic panchromatic mean: %s, Synthetic panchromatic std: %s", params['synth_mean'], params['synth_std'])
+    for i in range(ms.shape[0]):
+        logger.debug("Band %d - Gain: %s, Covariance: %s, Variance: %s, Correlation with PAN: %s", i + 1,
+                     params['gains'][i], params['covar'][i], params['synth_std'] ** 2, params['corr_pan'][i])
+
+    # Adjust the pan to the synthetic pan statistics and inject the residual into every band
+    ms_sharp = apply_gs_injection(ms, pan, params, out=out, backend=backend)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for i in range(ms_sharp.shape[0]):
+            logger.debug("Band %d - Sharpened band stats - Min: %.2f, Max: %.2f, Mean: %.2f", i + 1,
+                         np.min(ms_sharp[i]), np.max(ms_sharp[i]), np.mean(ms_sharp[i]))
+    logger.info("Pansharpening completed.")
+    return ms_sharp #shape : (bands, H, W)
+
+def gs_parameters_from_moments(mean, covariance, weights=None):
+    """
+    Derives the Gram-Schmidt parameters from the joint statistics of the MS bands and the PAN band.
+
+    mean: 1D array of length bands + 1 holding the mean of each MS band followed by the mean of the PAN.
+    covariance: (bands + 1, bands + 1) population covariance matrix, in the same order.
+    weights: Optional weights for the synthetic pan; if None, they are estimated from correlation with the PAN.
+
+    Returns a dict with the synthetic pan weights, the PAN and synthetic pan statistics and the clipped
+    gain of each band, i.e. everything `apply_gs_injection` needs to process any block of the scene.
+    Since the synthetic pan is linear in the MS bands, its mean, variance and covariance with each band
+    follow directly from the MS moments without ever forming the synthetic pan image.
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    covariance = np.asarray(covariance, dtype=np.float64)
+    nb_bands = len(mean) - 1
+    ms_cov = covariance[:nb_bands, :nb_bands]
+    ms_var = np.diag(ms_cov)
+    pan_var = covariance[nb_bands, nb_bands]
+
+    # Correlation between each MS band and the PAN band
+    denom = np.sqrt(ms_var * pan_var)
+    corr_pan = np.divide(covariance[:nb_bands, nb_bands], denom, out=np.zeros(nb_bands), where=denom > 0)
+
     if weights is None:
-        # Estimate weights based on correlation between each MS band and the PAN band
-        weights = np.zeros(ms.shape[0])
-        for i in range(ms.shape[0]):
-            # Calculate correlation between MS band and PAN
-            corr = np.corrcoef(ms[i].flatten(), pan.flatten())[0, 1]
-            # Use absolute correlation as weight (higher correlation = higher weight)
-            weights[i] = abs(corr)
-        
-        # Normalize weights to sum to 1
+        # Use absolute correlation as weight (higher correlation = higher weight)
+        weights = np.abs(corr_pan)
         if np.sum(weights) > 0:
             weights = weights / np.sum(weights)
         else:
             # Fallback to equal weights if correlations are all zero
-            weights = np.ones(ms.shape[0]) / ms.shape[0]
-    
-    print("Weights used for synthetic panchromatic image:", weights)
-    
-    # Compute a synthetic panchromatic image as a weighted sum of the multispectral bands.
-    pan_synth = np.tensordot(weights, ms, axes=(0, 0))
-    print("Synthetic panchromatic image computed:", pan_synth)
-    print("Synthetic panchromatic image stats - Min:", np.min(pan_synth), "Max:", np.max(pan_synth), "Mean:", np.mean(pan_synth))
-    print("Synthetic panchromatic image computed.")
-
-    # Adjust the high-resolution pan to match the statistics (mean, std) of the synthetic pan.
-    pan_mean, pan_std = np.mean(pan), np.std(pan) #mean and std of the panchromatic image
-    pan_synth_mean, pan_synth_std = np.mean(pan_synth), np.std(pan_synth) #mean and std of the synthetic panchromatic image
-    
+            weights = np.ones(nb_bands) / nb_bands
+    weights = np.asarray(weights, dtype=np.float64)
+
+    synth_mean = weights @ mean[:nb_bands]
+    covar = ms_cov @ weights # covariance between each MS band and the synthetic PAN
+    var_synth = weights @ covar # variance of the synthetic PAN
+
+    pan_std = np.sqrt(pan_var)
     # Avoid division by zero
     if pan_std == 0:
         pan_std = 1e-10
-    
-    print("Panchromatic mean:", pan_mean, "Panchromatic std:", pan_std)
-    print("Synthetic panchromatic mean:", pan_synth_mean, "Synthetic panchromatic std:", pan_synth_std)
-    print("Adjusting high-resolution panchromatic image...")
-    pan_adjusted = (pan - pan_mean) * (pan_synth_std / pan_std) + pan_synth_mean #ensures the intensity range of the pan image is consistent with the synthetic pan
-    print("High-resolution panchromatic image after adjustment:", pan_adjusted)
-    print("High-resolution panchromatic image adjusted to synthetic pan statistics.")
-
-    # Calculate the gain factor for each MS band 
-    ms_sharp = np.zeros_like(ms, dtype=np.float32) #will hold the sharpened MS image
-    for i in range(ms.shape[0]): #loop over each band
-        ms_band = ms[i].astype(np.float32)
-        # Compute gain as the ratio of covariance between the MS band and the synthetic PAN to the variance of the synthetic PAN
-        print(f"Band {i+1} - MS Band stats - Min:", np.min(ms_band), "Max:", np.max(ms_band), "Mean:", np.mean(ms_band))
-        print(f"Band {i+1} - ms_band:", ms_band)
-        ms_band_mean = np.mean(ms_band)
-        pan_synth_mean_local = np.mean(pan_synth)
-        covar = np.mean((ms_band - ms_band_mean) * (pan_synth - pan_synth_mean_local)) #covariance between the MS band and the synthetic PAN
-        var_synth = np.mean((pan_synth - pan_synth_mean_local)**2) #variance of the synthetic PAN
-
-        # Avoid division by zero
-        if var_synth == 0:
-            var_synth = 1e-10
-        gain = covar / var_synth # This determines how much of the panchromatic image should be used to enhance the MS band
-        
-        # Limit the gain to prevent excessive enhancement but allow more flexibility
-        # Use a more adaptive approach based on the band's correlation with PAN
-        corr = np.corrcoef(ms_band.flatten(), pan.flatten())[0, 1]
-        max_gain = 5.0 if abs(corr) > 0.5 else 3.0  # Higher limit for strongly correlated bands
-        gain = np.clip(gain, -max_gain, max_gain)  # Allow negative gains but limit magnitude
-        
-        print(f"Band {i+1} - Gain: {gain}, Covariance: {covar}, Variance: {var_synth}, Correlation with PAN: {corr}")
-        print(f"Band {i+1} - Covariance: {covar}, Variance: {var_synth}, Gain: {gain}")
-        print(f"pan_adjusted: {pan_adjusted}")
-        print(f"pan_synth: {pan_synth}")
-        print(f"Residual (pan_adjusted - pan_synth): {pan_adjusted - pan_synth}")
-        print(f"Band {i+1} - Gain: {gain}, Residual: {pan_adjusted - pan_synth}")
-        # Apply the Gram-Schmidt transformation
-        # Enhances the MS spatial details by adding the residual between the adjusted pan and the synthetic pan
-        ms_sharp[i] = ms_band + gain * (pan_adjusted - pan_synth)
-        
-        # Clip negative values to ensure non-negative output
-        ms_sharp[i] = np.clip(ms_sharp[i], 0, None)
-        
-        print(f"Band {i+1} - Sharpened band stats - Min:", np.min(ms_sharp[i]), "Max:", np.max(ms_sharp[i]), "Mean:", np.mean(ms_sharp[i]))
-    
-    print("Pansharpening completed.")
-    return ms_sharp #shape : (bands, H, W)
\ No newline at end of file
+    if var_synth == 0:
+        var_synth = 1e-10
+
+    gains = covar / var_synth
+    max_gain = np.where(np.abs(corr_pan) > 0.5, 5.0, 3.0) # Higher limit for strongly correlated bands
+    gains = np.clip(gains, -max_gain, max_gain)
+
+    return {
+        'weights': weights,
+        'pan_mean': mean[nb_bands],
+        'pan_std': pan_std,
+        'synth_mean': synth_mean,
+        'synth_std': np.sqrt(var_synth),
+        'gains': gains,
+        'covar': covar,
+        'corr_pan': corr_pan,
+    }
+
+
+def apply_gs_injection(ms, pan, params, out=None, backend='numpy'):
+    """
+    Applies the Gram-Schmidt detail injection to a block of upsampled MS data.
+
+    ms: 3D numpy array (bands, h, w) of MS data already at PAN resolution.
+    pan: 2D numpy array (h, w) covering the same pixels as ms.
+    params: Dict returned by `gs_parameters_from_moments` (computed over the whole scene).
+    out: Optional float32 array of the same shape as ms to write the result into (may be ms itself).
+    backend: 'numpy' (this code, the reference), 'numba' (one compiled pass per pixel) or 'auto'.
+
+    Returns the sharpened block of shape (bands, h, w).
+    """
+    if out is None:
+        out = np.empty(ms.shape, dtype=np.float32)
+    weights = params['weights'].astype(np.float32)
+    scale = np.float32(params['synth_std'] / params['pan_std'])
+    offset = np.float32(params['synth_mean'] - params['pan_mean'] * params['synth_std'] / params['pan_std'])
+    if resolve_backend(backend) == 'numba':
+        return gs_injection(ms, pan, weights, scale, offset, params['gains'], out)
+
+    # The residual is the only full-size temporary; the output planes serve as scratch space
+    # unless the output overwrites the input.
+    in_place = np.shares_memory(out, ms)
+    residual = np.empty(pan.shape, dtype=np.float32)
+    scratch = np.empty_like(residual) if in_place else out[0]
+
+    # Synthetic pan, accumulated band by band so that integer MS data is never cast as a whole
+    np.multiply(ms[0], weights[0], out=residual)
+    for i in range(1, ms.shape[0]):
+        np.multiply(ms[i], weights[i], out=scratch)
+        residual += scratch
+
+    # residual = pan_adjusted - pan_synth, with pan_adjusted = (pan - pan_mean) * (synth_std / pan_std) + synth_mean
+    np.multiply(pan, scale, out=scratch)
+    scratch += offset
+    np.subtract(scratch, residual, out=residual)
+
+    for i, gain in enumerate(params['gains']):
+        detail = scratch if in_place else out[i]
+        np.multiply(residual, np.float32(gain), out=detail)
+        np.add(ms[i], detail, out=out[i])
+        np.maximum(out[i], 0, out=out[i]) # Clip negative values to ensure non-negative output
+    return out
+
+def pansharpen_gs_fused(ms, pan, ms_transform=None, pan_transform=None, weights=None, block_rows=256, out=None, backend='numpy'):
+    """
+    Gram-Schmidt pansharpening straight from the MS bands at their own resolution: each block of rows is
+    bilinearly upsampled on the fly and sharpened in the same pass, so the upsampled MS stack never exists.
+    The result matches pansharpen_gs applied to the bilinearly upsampled stack to within rounding: the stack
+    resampled by GDAL (resample_ms_to_pan) is rounded to the uint16 band dtype, so they can differ by up to 1 DN.
+
+    ms: 3D numpy array (bands, h, w) of MS data at MS resolution.
+    pan: 2D numpy array (H, W) for the high-resolution panchromatic band.
+    ms_transform, pan_transform: Optional geotransforms aligning the two grids (see bilinear_grid); without them
+                                 MS and PAN are assumed to cover the same extent.
+    weights: Optional weights for the synthetic pan (see pansharpen_gs).
+    block_rows: Number of PAN rows upsampled at a time.
+    out: Optional float32 array (bands, H, W) to write the result into.
+    backend: Injection backend, see apply_gs_injection.
+
+    Returns the sharpened image of shape (bands, H, W) in float32.
+    """
+    logger.info("Starting fused Gram-Schmidt pansharpening...")
+    nb_bands, (height, width) = ms.shape[0], pan.shape
+    grid = bilinear_grid(ms.shape[1:], pan.shape, ms_transform, pan_transform)
+    if out is None:
+        out = np.empty((nb_bands, height, width), dtype=np.float32)
+
+    # Statistics pass over the upsampled MS and the PAN, one block of rows at a time
+    moments = JointMoments(nb_bands + 1)
+    block = None
+    for row in range(0, height, block_rows):
+        rows = min(block_rows, height - row)
+        if block is None or block.shape[1] != rows:
+            block = np.empty((nb_bands + 1, rows, width), dtype=np.float32)
+        upsample_rows(ms, grid, row, rows, out=block[:nb_bands])
+        block[nb_bands] = pan[row:row + rows]
+        moments.update(block)
+    params = gs_parameters_from_moments(moments.mean, moments.covariance, weights)
+    logger.info("Weights used for synthetic panchromatic image: %s", params['weights'])
+
+    # Injection pass: the blocks are upsampled into the output and sharpened in place
+    for row in range(0, height, block_rows):
+        rows = min(block_rows, height - row)
+        out_block = upsample_rows(ms, grid, row, rows, out=out[:, row:row + rows])
+        apply_gs_injection(out_block, pan[row:row + rows], params, out=out_block, backend=backend)
+    logger.info("Pansharpening completed.")
+    return out
@@ -0,0 +1,114 @@
+import logging
+import numpy as np
+import cv2
+from rasterio.windows import Window
+
+from .raster_io import BLOCK_SIZE, open_output
+from .tiling import open_aligned_bands
+from .upsampling import bilinear_grid, upsample_rows
+
+logger = logging.getLogger(__name__)
+
+def pan_high_frequencies(pan, kernel_size=5, sigma=1.0):
+    """
+    High-frequency layer of the PAN band: PAN minus its Gaussian low-pass version.
+    Computed in float32 so that negative details are kept (uint16 subtraction would wrap around).
+    """
+    pan = pan.astype(np.float32, copy=False)
+    pan_filtered = cv2.GaussianBlur(pan, (kernel_size, kernel_size), sigmaX=sigma)
+    return np.subtract(pan, pan_filtered, out=pan_filtered)
+
+def pansharpen_hpf(ms, pan, kernel_size=5, sigma=1.0, out=None):
+    """
+    Performs pansharpening using High Pass Filtering: the high frequencies of the PAN band are added to every MS band.
+
+    ms: 3D numpy array of shape (bands, H, W) for multispectral data (already upsampled to the PAN grid).
+    pan: 2D numpy array (H, W) for the high-resolution panchromatic band.
+    kernel_size, sigma: Size and standard deviation of the Gaussian low-pass filter applied to PAN.
+    out: Optional float32 array (bands, H, W) to write the result into.
+
+    Returns the sharpened image of shape (bands, H, W) in float32.
+    """
+    logger.info("Starting High Pass Filtering pansharpening...")
+    if out is None:
+        out = np.empty(ms.shape, dtype=np.float32)
+    pan_hf = pan_high_frequencies(pan, kernel_size, sigma)
+    for i in range(ms.shape[0]):
+        np.add(ms[i], pan_hf, out=out[i])
+    logger.info("Pansharpening completed.")
+    return out
+
+def pansharpen_hpf_fused(ms, pan, ms_transform=None, pan_transform=None, kernel_size=5, sigma=1.0, block_rows=256, out=None):
+    """
+    High Pass Filtering straight from the MS bands at their own resolution: each block of rows is bilinearly
+    upsampled into the output and the PAN high frequencies of the same rows are added in the same pass, so
+    neither the upsampled MS stack nor the full-size PAN high frequencies ever exist.
+    The result matches pansharpen_hpf applied to the bilinearly upsampled stack to within rounding: the stack
+    resampled by GDAL (resample_ms_to_pan) is rounded to the uint16 band dtype, so they can differ by up to 1 DN.
+
+    ms: 3D numpy array (bands, h, w) of MS data at MS resolution.
+    pan: 2D numpy array (H, W) for the high-resolution panchromatic band.
+    ms_transform, pan_transform: Optional geotransforms aligning the two grids (see bilinear_grid).
+    kernel_size, sigma: Size and standard deviation of the Gaussian low-pass filter applied to PAN.
+    block_rows: Number of PAN rows processed at a time.
+    out: Optional float32 array (bands, H, W) to write the result into.
+
+    Returns the sharpened image of shape (bands, H, W) in float32.
+    """
+    logger.info("Starting fused High Pass Filtering pansharpening...")
+    height, width = pan.shape
+    grid = bilinear_grid(ms.shape[1:], pan.shape, ms_transform, pan_transform)
+    if out is None:
+        out = np.empty((ms.shape[0], height, width), dtype=np.float32)
+    halo = kernel_size // 2
+    for row in range(0, height, block_rows):
+        rows = min(block_rows, height - row)
+        # the blur of rows read with a halo matches the blur of the whole band (same reasoning as the strips)
+        top, bottom = max(row - halo, 0), min(row + rows + halo, height)
+        pan_hf = pan_high_frequencies(pan[top:bottom], kernel_size, sigma)[row - top:row - top + rows]
+        out_block = upsample_rows(ms, grid, row, rows, out=out[:, row:row + rows])
+        out_block += pan_hf
+    logger.info("Pansharpening completed.")
+    return out
+
+def pansharpen_hpf_strips(ms_paths, pan_path, output_path, strip_rows=512, kernel_size=5, sigma=1.0, overviews=True, cog=True):
+    """
+    High Pass Filtering of a full scene in horizontal strips, written incrementally to a tiled GeoTIFF.
+
+    Each PAN strip is read with kernel_size // 2 extra rows above and below, so the blur (and therefore the
+    high-frequency layer) is identical to filtering the whole band; the MS bands are read for the same rows
+    directly on the PAN grid. Neither the PAN high frequencies nor the upsampled MS stack ever exist at full
+    scene size.
+    Args:
+        ms_paths (list): Paths of the multispectral bands (any resolution, resampled on the fly).
+        pan_path (str): Path of the panchromatic band, which defines the output grid.
+        output_path (str): Path of the float32 GeoTIFF to write, one band per MS band.
+        strip_rows (int): Number of output rows per strip (multiple of the 256-pixel output blocks).
+        kernel_size, sigma: Size and standard deviation of the Gaussian low-pass filter applied to PAN.
+        overviews, cog (bool): Build internal overviews and write the cloud-optimised layout (see open_output).
+    """
+    if strip_rows % BLOCK_SIZE != 0:
+        raise ValueError(f"strip_rows must be a multiple of {BLOCK_SIZE} (GeoTIFF block size).")
+    halo = kernel_size // 2
+
+    with open_aligned_bands(ms_paths, pan_path) as (ms_sources, pan_src):
+        height, width = pan_src.height, pan_src.width
+        strip_rows = min(strip_rows, -(-height // BLOCK_SIZE) * BLOCK_SIZE) # whole blocks, even for a single strip
+        logger.info("High Pass Filtering %dx%d pixels in strips of %d rows, writing to %s...", height, width, strip_rows, output_path)
+
+        strip = np.empty((len(ms_sources), strip_rows, width), dtype=np.float32)
+        with open_output(output_path, pan_src.meta, len(ms_sources), 'float32', overviews=overviews, cog=cog) as dst:
+            for row in range(0, height, strip_rows):
+                rows = min(strip_rows, height - row)
+                top, bottom = max(row - halo, 0), min(row + rows + halo, height)
+                pan_strip = pan_src.read(1, window=Window(0, top, width, bottom - top))
+                pan_hf = pan_high_frequencies(pan_strip, kernel_size, sigma)[row - top:row - top + rows]
+
+                window = Window(0, row, width, rows)
+                out = strip[:, :rows]
+                for i, src in enumerate(ms_sources):
+                    out[i] = src.read(1, window=window)
+                    out[i] += pan_hf
+                dst.write(out, window=window)
+
+    logger.info("Strip pansharpening completed.")
@@ -0,0 +1,77 @@
+"""
+Optional compiled kernels for the per-pixel work of the Gram-Schmidt injection and of the spectral angle.
+
+Each kernel fuses a chain of NumPy operations into one parallel loop over the rows or pixels, reading the input
+in its own dtype, so none of the NumPy temporaries are created. Numba is optional: it is detected at import and
+backend='auto' falls back to the NumPy code, which remains the reference implementation (benchmark.py
+--check-backends compares the two).
+"""
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError: # the NumPy backend is always available
+    numba = None
+
+HAVE_NUMBA = numba is not None
+BACKENDS = ('auto', 'numpy', 'numba')
+
+def resolve_backend(backend):
+    """Returns 'numpy' or 'numba' for a backend option ('auto' picks Numba when it is installed)."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}.")
+    if backend == 'auto':
+        return 'numba' if HAVE_NUMBA else 'numpy'
+    if backend == 'numba' and not HAVE_NUMBA:
+        raise ImportError("The numba backend needs Numba (pip install numba).")
+    return backend
+
+if HAVE_NUMBA:
+    @numba.njit(parallel=True, cache=True)
+    def _gs_injection(ms, pan, weights, scale, offset, gains, out):
+        nb_bands, height, width = ms.shape
+        for r in numba.prange(height):
+            for c in range(width):
+                synth = np.float32(ms[0, r, c]) * weights[0]
+                for b in range(1, nb_bands):
+                    synth += np.float32(ms[b, r, c]) * weights[b]
+                residual = (np.float32(pan[r, c]) * scale + offset) - synth
+                for b in range(nb_bands):
+                    value = np.float32(ms[b, r, c]) + residual * gains[b]
+                    out[b, r, c] = value if value > 0 else np.float32(0)
+
+    @numba.njit(parallel=True, cache=True)
+    def _spectral_angles(ref, test, eps, additive, out):
+        nb_bands, n = ref.shape
+        for i in numba.prange(n):
+            dot = np.float32(0)
+            ref_sq = np.float32(0)
+            test_sq = np.float32(0)
+            for b in range(nb_bands):
+                x = np.float32(ref[b, i])
+                y = np.float32(test[b, i])
+                dot += x * y
+                ref_sq += x * x
+                test_sq += y * y
+            norms = math.sqrt(ref_sq * test_sq)
+            denom = norms + eps if additive else max(norms, eps)
+            out[i] = math.acos(min(max(dot / denom, -1.0), 1.0))
+
+def gs_injection(ms, pan, weights, scale, offset, gains, out):
+    """
+    Compiled Gram-Schmidt injection (see gram_schmidt.apply_gs_injection, the reference): synthetic pan, residual
+    against the adjusted PAN, gain multiply and clip at zero in one pass per pixel. out may be ms itself.
+    """
+    _gs_injection(ms, pan, np.asarray(weights, dtype=np.float32), np.float32(scale), np.float32(offset),
+                  np.asarray(gains, dtype=np.float32), out)
+    return out
+
+def spectral_angles(ref, test, eps=1e-8, additive=False):
+    """
+    Compiled spectral angle (radians) of every pixel of two (bands, n) views, as float32 of length n.
+    The norm product is guarded with max(norms, eps), or with norms + eps when additive is True.
+    """
+    out = np.empty(ref.shape[1], dtype=np.float32)
+    _spectral_angles(ref, test, np.float32(eps), additive, out)
+    return out
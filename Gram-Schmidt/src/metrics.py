@@ -0,0 +1,589 @@
+"""
+Streaming quality metrics for pansharpening.
+
+The accumulators below are fed chunk by chunk (rows of a scene, rasterio windows, tiles handled by other
+workers) and combined with `merge`, so full-scene metrics never need both images in memory at once.
+Images can be bands-first (layout='chw', as in Gram-Schmidt) or bands-last (layout='hwc', as in the Bayesian
+scripts); both are handled through reshaped views, never transposed copies.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from .kernels import resolve_backend, spectral_angles
+
+
+def band_view(chunk, n_bands, layout='chw'):
+    """View of a chunk as (n_bands, pixels), without copying for contiguous CHW or HWC arrays."""
+    if layout == 'chw':
+        return chunk.reshape(n_bands, -1)
+    if layout == 'hwc':
+        return chunk.reshape(-1, n_bands).T
+    raise ValueError(f"Unknown layout {layout!r}, expected 'chw' or 'hwc'.")
+
+
+class BandRanges:
+    """Per-band minimum and maximum of a reference and a test image, accumulated chunk by chunk."""
+
+    def __init__(self, n_bands, layout='chw'):
+        self.n_bands = n_bands
+        self.layout = layout
+        self.reference = np.tile([np.inf, -np.inf], (n_bands, 1))
+        self.test = np.tile([np.inf, -np.inf], (n_bands, 1))
+
+    @staticmethod
+    def _fold(ranges, values):
+        if values.shape[1]:
+            np.minimum(ranges[:, 0], values.min(axis=1), out=ranges[:, 0])
+            np.maximum(ranges[:, 1], values.max(axis=1), out=ranges[:, 1])
+
+    def update(self, chunk_ref, chunk_test):
+        """Adds a chunk of both images, each of shape (n_bands, ...) or (..., n_bands) depending on the layout."""
+        self._fold(self.reference, band_view(chunk_ref, self.n_bands, self.layout))
+        self._fold(self.test, band_view(chunk_test, self.n_bands, self.layout))
+        return self
+
+    def merge(self, other):
+        """Merges the ranges accumulated by another BandRanges over other chunks."""
+        self._fold(self.reference, other.reference)
+        self._fold(self.test, other.test)
+        return self
+
+
+class MetricAccumulator:
+    """
+    Mergeable sums behind CC, PSNR, MAE, RMSE, SAM and ERGAS of a test image against a reference.
+
+    Each chunk is cast to float32 once; the sums are kept in float64. Means, variances and the
+    covariance of every band are merged pairwise (Chan et al.) rather than through raw E[x^2] sums, so
+    CC stays accurate on large scenes of uint16 DNs. When the band ranges of both images are given (from
+    a BandRanges pass), the error metrics are also accumulated on the band-by-band min-max normalised
+    images, as used for the spatial metrics of the Gram-Schmidt evaluation. backend selects the spectral angle
+    implementation ('numpy', 'numba' or 'auto', see src/kernels.py).
+    """
+
+    def __init__(self, n_bands, reference_ranges=None, test_ranges=None, layout='chw', backend='numpy'):
+        self.n_bands = n_bands
+        self.layout = layout
+        self.backend = resolve_backend(backend)
+        self.count = 0
+        self.mean_ref = np.zeros(n_bands)
+        self.mean_test = np.zeros(n_bands)
+        self.m2_ref = np.zeros(n_bands)
+        self.m2_test = np.zeros(n_bands)
+        self.comoment = np.zeros(n_bands)
+        self.abs_err = np.zeros(n_bands)
+        self.sq_err = np.zeros(n_bands)
+        self.peak = 0.0
+        self.angle = 0.0
+        self.normalised = reference_ranges is not None and test_ranges is not None
+        if self.normalised:
+            self.ref_offset, self.ref_scale = normalisation(reference_ranges)
+            self.test_offset, self.test_scale = normalisation(test_ranges)
+            self.norm_abs_err = np.zeros(n_bands)
+            self.norm_sq_err = np.zeros(n_bands)
+
+    def update(self, chunk_ref, chunk_test):
+        """
+        Adds a chunk of both images.
+        Args:
+            chunk_ref, chunk_test (numpy.ndarray): Arrays of shape (n_bands, ...) ('chw') or (..., n_bands) ('hwc')
+                                                  covering the same pixels.
+        """
+        if chunk_ref.shape != chunk_test.shape:
+            raise ValueError("Reference and test chunks must have the same shape.")
+        ref = band_view(chunk_ref, self.n_bands, self.layout).astype(np.float32)
+        test = band_view(chunk_test, self.n_bands, self.layout).astype(np.float32)
+        count = ref.shape[1]
+        if count == 0:
+            return self
+
+        # Spectral angle of every pixel
+        if self.backend == 'numba':
+            angle = spectral_angles(ref, test, 1e-10, additive=True).sum(dtype=np.float64)
+        else:
+            dot = np.einsum('bn,bn->n', ref, test)
+            norms = np.sqrt(np.einsum('bn,bn->n', ref, ref) * np.einsum('bn,bn->n', test, test))
+            cos_angle = np.clip(dot / (norms + 1e-10), -1.0, 1.0)
+            angle = np.arccos(cos_angle).sum(dtype=np.float64)
+        peak = max(float(ref.max()), float(test.max()))
+
+        # Errors on the original values
+        error = test - ref
+        abs_err = np.abs(error).sum(axis=1, dtype=np.float64)
+        sq_err = np.einsum('bn,bn->b', error, error, dtype=np.float64)
+
+        if self.normalised:
+            np.subtract(test * self.test_scale.astype(np.float32)[:, None], ref * self.ref_scale.astype(np.float32)[:, None], out=error)
+            error -= (self.test_offset * self.test_scale - self.ref_offset * self.ref_scale).astype(np.float32)[:, None]
+            self.norm_abs_err += np.abs(error).sum(axis=1, dtype=np.float64)
+            self.norm_sq_err += np.einsum('bn,bn->b', error, error, dtype=np.float64)
+
+        # Moments of the chunk, centred on its own means
+        mean_ref = ref.mean(axis=1, dtype=np.float64)
+        mean_test = test.mean(axis=1, dtype=np.float64)
+        ref -= mean_ref.astype(np.float32)[:, None]
+        test -= mean_test.astype(np.float32)[:, None]
+        m2_ref = np.einsum('bn,bn->b', ref, ref, dtype=np.float64)
+        m2_test = np.einsum('bn,bn->b', test, test, dtype=np.float64)
+        comoment = np.einsum('bn,bn->b', ref, test, dtype=np.float64)
+
+        self._combine(count, mean_ref, mean_test, m2_ref, m2_test, comoment)
+        self.abs_err += abs_err
+        self.sq_err += sq_err
+        self.peak = max(self.peak, peak)
+        self.angle += angle
+        return self
+
+    def merge(self, other):
+        """Merges the sums accumulated by another MetricAccumulator over disjoint pixels."""
+        if other.n_bands != self.n_bands or other.normalised != self.normalised:
+            raise ValueError("Cannot merge accumulators with different bands or normalisation.")
+        if other.count == 0:
+            return self
+        self._combine(other.count, other.mean_ref, other.mean_test, other.m2_ref, other.m2_test, other.comoment)
+        self.abs_err += other.abs_err
+        self.sq_err += other.sq_err
+        self.peak = max(self.peak, other.peak)
+        self.angle += other.angle
+        if self.normalised:
+            self.norm_abs_err += other.norm_abs_err
+            self.norm_sq_err += other.norm_sq_err
+        return self
+
+    def _combine(self, count, mean_ref, mean_test, m2_ref, m2_test, comoment):
+        total = self.count + count
+        delta_ref = mean_ref - self.mean_ref
+        delta_test = mean_test - self.mean_test
+        weight = self.count * count / total
+        self.m2_ref += m2_ref + delta_ref**2 * weight
+        self.m2_test += m2_test + delta_test**2 * weight
+        self.comoment += comoment + delta_ref * delta_test * weight
+        self.mean_ref += delta_ref * (count / total)
+        self.mean_test += delta_test * (count / total)
+        self.count = total
+
+    def result(self, ratio=4, data_range=None):
+        """
+        Metrics of the accumulated pixels.
+        Args:
+            ratio (float): Resolution ratio between PAN and MS, for ERGAS.
+            data_range (float): Peak value for PSNR (default: maximum value of both images).
+        Returns:
+            dict: Per-band arrays 'band_cc', 'band_mae', 'band_rmse', 'band_psnr', 'band_mean_reference' (and 'band_mae_norm',
+                  'band_rmse_norm', 'band_psnr_norm' on the normalised images when ranges were given),
+                  and the scalars 'SAM (radians)', 'SAM (degrees)' and 'ERGAS'.
+        """
+        if self.count == 0:
+            raise ValueError("No samples accumulated.")
+        n = self.count
+        peak = self.peak if data_range is None else data_range
+        mse = self.sq_err / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                'band_cc': self.comoment / np.sqrt(self.m2_ref * self.m2_test),
+                'band_mae': self.abs_err / n,
+                'band_rmse': np.sqrt(mse),
+                'band_psnr': psnr_from_mse(mse, peak),
+                'band_mean_reference': self.mean_ref.copy(),
+            }
+            rmse_relative = np.sqrt(mse) / (self.mean_ref + 1e-10)
+        metrics['ERGAS'] = 100 * ratio * np.sqrt(np.mean(rmse_relative**2))
+        metrics['SAM (radians)'] = self.angle / n
+        metrics['SAM (degrees)'] = np.degrees(metrics['SAM (radians)'])
+        if self.normalised:
+            norm_mse = self.norm_sq_err / n
+            metrics['band_mae_norm'] = self.norm_abs_err / n
+            metrics['band_rmse_norm'] = np.sqrt(norm_mse)
+            metrics['band_psnr_norm'] = psnr_from_mse(norm_mse, 1.0)
+        return metrics
+
+
+def normalisation(ranges):
+    """Offsets and scales of the band-by-band min-max normalisation to [0, 1] (a flat band gets a range of 1e-10)."""
+    ranges = np.asarray(ranges, dtype=np.float64)
+    span = ranges[:, 1] - ranges[:, 0]
+    span[span == 0] = 1e-10
+    return ranges[:, 0], 1.0 / span
+
+def psnr_from_mse(mse, peak):
+    """PSNR in dB for each band (inf where the images are identical)."""
+    with np.errstate(divide='ignore'):
+        return np.where(mse == 0, np.inf, 20 * np.log10(peak) - 10 * np.log10(np.maximum(mse, 1e-300)))
+
+def compute_metrics(reference, test, ratio=4, layout='chw', data_range=None, normalise=False, chunk_rows=512, backend='numpy'):
+    """
+    Metrics of an in-memory (or memory-mapped) test image against a reference, computed in chunks of rows.
+    Args:
+        reference, test (numpy.ndarray): Images of shape (bands, h, w) for layout='chw' or (h, w, bands) for 'hwc'.
+        ratio (float): Resolution ratio between PAN and MS, for ERGAS.
+        layout (str): 'chw' or 'hwc'.
+        data_range (float): Peak value for PSNR (default: maximum value of both images).
+        normalise (bool): Also compute the error metrics on the min-max normalised bands (extra min/max pass).
+        chunk_rows (int): Number of rows per chunk.
+        backend (str): Spectral angle backend, see MetricAccumulator.
+    Returns:
+        dict: Output of MetricAccumulator.result.
+    """
+    if reference.shape != test.shape:
+        raise ValueError("Images must be the same shape. Resample the original MS image first.")
+    n_bands = reference.shape[0] if layout == 'chw' else reference.shape[-1]
+    row_axis = 1 if layout == 'chw' else 0
+    height = reference.shape[row_axis]
+    def chunks():
+        for row in range(0, height, chunk_rows):
+            rows = (slice(None),) * row_axis + (slice(row, row + chunk_rows),)
+            yield reference[rows], test[rows]
+
+    accumulator = MetricAccumulator(n_bands, layout=layout, backend=backend)
+    if normalise:
+        ranges = BandRanges(n_bands, layout)
+        for chunk_ref, chunk_test in chunks():
+            ranges.update(chunk_ref, chunk_test)
+        accumulator = MetricAccumulator(n_bands, ranges.reference, ranges.test, layout, backend)
+    for chunk_ref, chunk_test in chunks():
+        accumulator.update(chunk_ref, chunk_test)
+    return accumulator.result(ratio, data_range)
+
+def spectral_angle_map(reference, test, layout='chw', eps=1e-8, backend='numpy'):
+    """
+    Spectral angle (radians) between the two images at every pixel, as a float32 (h, w) map.
+    The 'numba' backend reads both images in their own dtype in a single pass (see src/kernels.py).
+    """
+    if reference.shape != test.shape:
+        raise ValueError("Images must be the same shape.")
+    n_bands = reference.shape[0] if layout == 'chw' else reference.shape[-1]
+    spatial_shape = reference.shape[1:] if layout == 'chw' else reference.shape[:-1]
+    if resolve_backend(backend) == 'numba':
+        angle = spectral_angles(band_view(reference, n_bands, layout), band_view(test, n_bands, layout), eps)
+        return angle.reshape(spatial_shape)
+    ref = band_view(reference, n_bands, layout).astype(np.float32)
+    test = band_view(test, n_bands, layout).astype(np.float32)
+    dot = np.einsum('bn,bn->n', ref, test)
+    norms = np.sqrt(np.einsum('bn,bn->n', ref, ref) * np.einsum('bn,bn->n', test, test))
+    angle = np.arccos(np.clip(dot / np.maximum(norms, eps), -1.0, 1.0))
+    return angle.reshape(spatial_shape)
+
+def ssim_band(x, y, data_range, win_size=7, tile_rows=512, x_norm=(0.0, 1.0), y_norm=(0.0, 1.0)):
+    """
+    Mean SSIM of two 2D bands, equivalent to skimage.metrics.structural_similarity with its defaults
+    (uniform win_size x win_size window, sample covariance, K1=0.01, K2=0.03).
+
+    Like skimage, the mean is taken over the pixels whose window lies inside the image, so only those are
+    computed: the bands are processed in tiles of rows read with win_size // 2 extra rows on each side, and
+    the means and second moments come from separable box filters in float32 (moments are taken around the
+    tile mean to limit cancellation). The result matches skimage within 1e-5 in absolute value.
+    Args:
+        x, y (numpy.ndarray): Bands of the same shape (any dtype, e.g. uint16 or memmaps).
+        data_range (float): Dynamic range of the (normalised) values.
+        win_size (int): Odd side of the window.
+        tile_rows (int): Number of output rows per tile.
+        x_norm, y_norm (tuple): (offset, scale) applied on the fly to each band, e.g. from `normalisation`.
+    Returns:
+        float: Mean SSIM.
+    """
+    if x.shape != y.shape:
+        raise ValueError("Bands must have the same shape.")
+    pad = win_size // 2
+    height, width = x.shape
+    if min(height, width) < win_size:
+        raise ValueError("Bands must be at least win_size pixels on each side.")
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    cov_norm = win_size * win_size / (win_size * win_size - 1)
+    window = (win_size, win_size)
+
+    def load(band, norm, rows):
+        tile = band[rows].astype(np.float32)
+        tile -= np.float32(norm[0])
+        tile *= np.float32(norm[1])
+        return tile
+
+    total = 0.0
+    for row in range(pad, height - pad, tile_rows):
+        rows = slice(row - pad, min(row + tile_rows, height - pad) + pad)
+        xt, yt = load(x, x_norm, rows), load(y, y_norm, rows)
+        valid = (slice(pad, -pad), slice(pad, -pad))
+        mu_x = cv2.blur(xt, window)[valid]
+        mu_y = cv2.blur(yt, window)[valid]
+        xt -= np.float32(xt.mean())
+        yt -= np.float32(yt.mean())
+        mu_xc = cv2.blur(xt, window)[valid] # means of the centred tiles
+        mu_yc = cv2.blur(yt, window)[valid]
+        var_x = cv2.blur(xt * xt, window)[valid] - mu_xc * mu_xc
+        var_y = cv2.blur(yt * yt, window)[valid] - mu_yc * mu_yc
+        cov_xy = cv2.blur(xt * yt, window)[valid] - mu_xc * mu_yc
+        numerator = (2 * mu_x * mu_y + c1) * (2 * cov_norm * cov_xy + c2)
+        denominator = (mu_x * mu_x + mu_y * mu_y + c1) * (cov_norm * (var_x + var_y) + c2)
+        total += (numerator / denominator).sum(dtype=np.float64)
+    return total / ((height - 2 * pad) * (width - 2 * pad))
+
+def band_ssim(reference, test, data_range, layout='chw', reference_ranges=None, test_ranges=None, workers=None, **kwargs):
+    """
+    SSIM of every band, the bands being processed in parallel threads (OpenCV releases the GIL).
+    Args:
+        reference, test (numpy.ndarray): Images of shape (bands, h, w) for layout='chw' or (h, w, bands) for 'hwc'.
+        data_range (float): Dynamic range of the values (1.0 when ranges are given).
+        reference_ranges, test_ranges: Optional per-band (min, max) to min-max normalise the bands on the fly.
+        workers (int): Number of threads (default: one per band).
+        kwargs: win_size and tile_rows, passed to ssim_band.
+    Returns:
+        numpy.ndarray: SSIM of each band.
+    """
+    n_bands = reference.shape[0] if layout == 'chw' else reference.shape[-1]
+    band = (lambda image, i: image[i]) if layout == 'chw' else (lambda image, i: image[..., i])
+    def norms(ranges):
+        if ranges is None:
+            return [(0.0, 1.0)] * n_bands
+        return list(zip(*normalisation(ranges)))
+    reference_norms, test_norms = norms(reference_ranges), norms(test_ranges)
+    def run(i):
+        return ssim_band(band(reference, i), band(test, i), data_range, x_norm=reference_norms[i], y_norm=test_norms[i], **kwargs)
+    with ThreadPoolExecutor(max_workers=workers or n_bands) as executor:
+        return np.array(list(executor.map(run, range(n_bands))))
+
+def q_index_matrix(mean, covariance):
+    """
+    Universal image quality index Q (Wang & Bovik) between every pair of variables, from their means (n_vars, ...)
+    and covariance matrices (n_vars, n_vars, ...), e.g. one per block: Q = 4 cov_xy mu_x mu_y / ((var_x + var_y) (mu_x^2 + mu_y^2)).
+    Pairs of constant variables (e.g. blocks outside the scene footprint) get Q = 1.
+    """
+    variance = np.einsum('ii...->i...', covariance)
+    mean_x, mean_y = mean[:, None], mean[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = 4 * covariance * mean_x * mean_y / ((variance[:, None] + variance[None, :]) * (mean_x**2 + mean_y**2))
+    return np.nan_to_num(q, nan=1.0)
+
+def block_moments(variables, block_size):
+    """
+    Means and covariance matrix of a stack of variables over each block of block_size x block_size pixels
+    (blocks at the right and bottom edges may be smaller), computed with block sums in float64.
+    Args:
+        variables (sequence): 2D arrays of the same shape (h, w), e.g. the bands of a chunk and the PAN rows.
+        block_size (int): Side of the blocks.
+    Returns:
+        tuple: (means (n_vars, hb, wb), covariances (n_vars, n_vars, hb, wb))
+    """
+    height, width = variables[0].shape
+    rows, cols = np.arange(0, height, block_size), np.arange(0, width, block_size)
+    counts = np.outer(np.diff(rows, append=height), np.diff(cols, append=width))
+    def block_sums(x):
+        return np.add.reduceat(np.add.reduceat(x, rows, axis=0), cols, axis=1)
+    n_vars = len(variables)
+    mean = np.stack([block_sums(x.astype(np.float64)) for x in variables]) / counts
+    covariance = np.empty((n_vars, n_vars) + counts.shape)
+    for i in range(n_vars):
+        for j in range(i, n_vars):
+            products = np.multiply(variables[i], variables[j], dtype=np.float64)
+            covariance[i, j] = covariance[j, i] = block_sums(products) / counts - mean[i] * mean[j]
+    return mean, covariance
+
+
+class QNRAccumulator:
+    """
+    No-reference quality (QNR) of a pansharpened image, accumulated chunk by chunk.
+
+    D_lambda compares the Q index between every pair of bands of the fused image with the same pair in the
+    original MS image; D_s compares the Q index of each fused band with the PAN band to that of each MS band
+    with the PAN band degraded to the MS grid. As in the QNR literature, Q is a local index: it is computed on
+    non-overlapping blocks of block_size pixels (32 by default) and averaged over the blocks. Only the sum of the
+    block Q indices and the number of blocks are kept, so chunks read in any order, or in other processes, merge
+    exactly, provided each chunk starts on a block row (chunk heights are multiples of block_size, except at the
+    bottom of the image).
+    """
+
+    def __init__(self, n_bands, block_size=32):
+        self.n_bands = n_bands
+        self.block_size = block_size
+        self.q_full = np.zeros((n_bands + 1, n_bands + 1)) # fused bands + PAN, on the PAN grid
+        self.q_reduced = np.zeros((n_bands + 1, n_bands + 1)) # MS bands + degraded PAN, on the MS grid
+        self.blocks_full = 0
+        self.blocks_reduced = 0
+
+    def _block_q(self, chunk, pan_chunk):
+        q = q_index_matrix(*block_moments(list(chunk) + [pan_chunk], self.block_size))
+        return q.sum(axis=(2, 3)), q.shape[2] * q.shape[3]
+
+    def update_full(self, fused_chunk, pan_chunk):
+        """Adds a chunk of the fused image (n_bands, h, w) and the same rows of the PAN band (h, w)."""
+        q_sum, blocks = self._block_q(fused_chunk, pan_chunk)
+        self.q_full += q_sum
+        self.blocks_full += blocks
+        return self
+
+    def update_reduced(self, ms_chunk, pan_low_chunk):
+        """Adds a chunk of the original MS image (n_bands, h, w) and of the PAN band degraded to the MS grid."""
+        q_sum, blocks = self._block_q(ms_chunk, pan_low_chunk)
+        self.q_reduced += q_sum
+        self.blocks_reduced += blocks
+        return self
+
+    def merge(self, other):
+        """Merges the block Q indices accumulated by another QNRAccumulator over other chunks."""
+        if other.block_size != self.block_size:
+            raise ValueError("Cannot merge QNR accumulators with different block sizes.")
+        self.q_full += other.q_full
+        self.q_reduced += other.q_reduced
+        self.blocks_full += other.blocks_full
+        self.blocks_reduced += other.blocks_reduced
+        return self
+
+    def result(self, p=1, q=1, alpha=1, beta=1):
+        """
+        Returns:
+            dict: 'D_lambda', 'D_s' (0 is best) and 'QNR' = (1 - D_lambda)^alpha (1 - D_s)^beta (1 is best).
+        """
+        if not self.blocks_full or not self.blocks_reduced:
+            raise ValueError("No samples accumulated.")
+        q_full = self.q_full / self.blocks_full
+        q_reduced = self.q_reduced / self.blocks_reduced
+        n = self.n_bands
+        off_diagonal = ~np.eye(n, dtype=bool)
+        d_lambda = (np.abs(q_full[:n, :n] - q_reduced[:n, :n])[off_diagonal] ** p).mean() ** (1 / p) if n > 1 else 0.0
+        d_s = (np.abs(q_full[:n, n] - q_reduced[:n, n]) ** q).mean() ** (1 / q)
+        return {'D_lambda': d_lambda, 'D_s': d_s, 'QNR': (1 - d_lambda) ** alpha * (1 - d_s) ** beta}
+
+
+def block_aligned_rows(chunk_rows, block_size):
+    """Rounds a chunk height down to whole blocks (at least one), so that chunks start on block rows."""
+    return max(block_size, chunk_rows // block_size * block_size)
+
+def compute_qnr(fused, ms, pan, pan_low, chunk_rows=512, block_size=32):
+    """
+    QNR of an in-memory fused image, in chunks of rows.
+    Args:
+        fused (numpy.ndarray): Pansharpened image (bands, H, W) on the PAN grid.
+        ms (numpy.ndarray): Original MS image (bands, h, w).
+        pan (numpy.ndarray): PAN band (H, W).
+        pan_low (numpy.ndarray): PAN band degraded to the MS grid (h, w).
+        chunk_rows (int): Number of rows per chunk (rounded down to whole blocks).
+        block_size (int): Side of the blocks the Q indices are computed on.
+    Returns:
+        dict: Output of QNRAccumulator.result.
+    """
+    accumulator = QNRAccumulator(fused.shape[0], block_size)
+    chunk_rows = block_aligned_rows(chunk_rows, block_size)
+    for row in range(0, fused.shape[1], chunk_rows):
+        accumulator.update_full(fused[:, row:row + chunk_rows], pan[row:row + chunk_rows])
+    for row in range(0, ms.shape[1], chunk_rows):
+        accumulator.update_reduced(ms[:, row:row + chunk_rows], pan_low[row:row + chunk_rows])
+    return accumulator.result()
+
+def _strips(height, chunk_rows, workers):
+    """Splits the rows into one contiguous run of strips per worker."""
+    starts = list(range(0, height, chunk_rows))
+    per_worker = -(-len(starts) // workers)
+    return [starts[i:i + per_worker] for i in range(0, len(starts), per_worker)]
+
+def _accumulate_windows(reference_path, test_path, rows, chunk_rows, make_accumulator):
+    accumulator = make_accumulator()
+    with rasterio.open(reference_path) as ref_src, rasterio.open(test_path) as test_src:
+        for row in rows:
+            window = Window(0, row, ref_src.width, min(chunk_rows, ref_src.height - row))
+            accumulator.update(ref_src.read(window=window), test_src.read(window=window))
+    return accumulator
+
+def evaluate_rasters(reference_path, test_path, ratio=4, chunk_rows=512, workers=1, normalise=True, data_range=None):
+    """
+    Metrics of a test GeoTIFF against a reference GeoTIFF on the same grid, read in strips of rows.
+
+    With normalise=True a first pass collects the band ranges for the normalised error metrics. With several
+    workers, each thread reads its own run of strips through its own dataset handles and the accumulators are
+    merged at the end.
+    Args:
+        reference_path, test_path (str): Multi-band rasters with the same shape.
+        ratio (float): Resolution ratio between PAN and MS, for ERGAS.
+        chunk_rows (int): Number of rows read at a time by each worker.
+        workers (int): Number of threads.
+        normalise (bool): Also compute the metrics on the min-max normalised bands.
+        data_range (float): Peak value for PSNR (default: maximum value of both images).
+    Returns:
+        dict: Output of MetricAccumulator.result.
+    """
+    with rasterio.open(reference_path) as ref_src, rasterio.open(test_path) as test_src:
+        if (ref_src.count, ref_src.height, ref_src.width) != (test_src.count, test_src.height, test_src.width):
+            raise ValueError("Reference and test rasters must have the same shape.")
+        n_bands, height = ref_src.count, ref_src.height
+
+    strips = _strips(height, chunk_rows, max(1, workers))
+    def run(make_accumulator):
+        with ThreadPoolExecutor(max_workers=len(strips)) as executor:
+            partials = list(executor.map(lambda rows: _accumulate_windows(reference_path, test_path, rows, chunk_rows, make_accumulator), strips))
+        for partial in partials[1:]:
+            partials[0].merge(partial)
+        return partials[0]
+
+    if normalise:
+        ranges = run(lambda: BandRanges(n_bands))
+        accumulator = run(lambda: MetricAccumulator(n_bands, ranges.reference, ranges.test))
+    else:
+        accumulator = run(lambda: MetricAccumulator(n_bands))
+    return accumulator.result(ratio, data_range)
+
+def evaluate_at_ms_resolution(sharpened_path, ms_paths, chunk_rows=512, data_range=None):
+    """
+    Metrics of a pansharpened GeoTIFF brought back to the grid of the original MS bands (area averaging,
+    read on the fly through a WarpedVRT) against those bands, in strips of rows. This is the comparison
+    made by the Gram-Schmidt and Bayesian scripts, without loading either image as a whole.
+    Args:
+        sharpened_path (str): Multi-band raster on the PAN grid, one band per MS band.
+        ms_paths (list): Paths of the original MS bands, in the same order.
+        chunk_rows (int): Number of MS rows read at a time.
+        data_range (float): Peak value for PSNR (default: maximum value of both images).
+    Returns:
+        dict: Output of MetricAccumulator.result, with ERGAS using the PAN/MS resolution ratio.
+    """
+    ms_sources = [rasterio.open(path) for path in ms_paths]
+    try:
+        grid = ms_sources[0]
+        with rasterio.open(sharpened_path) as sharpened_src:
+            ratio = grid.res[0] / sharpened_src.res[0]
+            with WarpedVRT(sharpened_src, crs=grid.crs, transform=grid.transform, width=grid.width,
+                           height=grid.height, resampling=Resampling.average) as sharpened:
+                accumulator = MetricAccumulator(len(ms_sources))
+                for row in range(0, grid.height, chunk_rows):
+                    window = Window(0, row, grid.width, min(chunk_rows, grid.height - row))
+                    reference = np.stack([src.read(1, window=window) for src in ms_sources])
+                    accumulator.update(reference, sharpened.read(window=window))
+    finally:
+        for src in ms_sources:
+            src.close()
+    return accumulator.result(ratio, data_range)
+
+def qnr_rasters(sharpened_path, ms_paths, pan_path, chunk_rows=512, block_size=32):
+    """
+    QNR of a pansharpened GeoTIFF, reading the fused image and the PAN band in strips, and the MS bands with
+    the PAN band averaged onto the MS grid (through a WarpedVRT) in strips.
+    Args:
+        sharpened_path (str): Multi-band raster on the PAN grid, one band per MS band.
+        ms_paths (list): Paths of the original MS bands, in the same order.
+        pan_path (str): Path of the PAN band.
+        chunk_rows (int): Number of rows read at a time (rounded down to whole blocks).
+        block_size (int): Side of the blocks the Q indices are computed on.
+    Returns:
+        dict: Output of QNRAccumulator.result.
+    """
+    accumulator = QNRAccumulator(len(ms_paths), block_size)
+    chunk_rows = block_aligned_rows(chunk_rows, block_size)
+    with rasterio.open(sharpened_path) as sharpened, rasterio.open(pan_path) as pan_src:
+        for row in range(0, sharpened.height, chunk_rows):
+            window = Window(0, row, sharpened.width, min(chunk_rows, sharpened.height - row))
+            accumulator.update_full(sharpened.read(window=window), pan_src.read(1, window=window))
+
+        ms_sources = [rasterio.open(path) for path in ms_paths]
+        try:
+            grid = ms_sources[0]
+            with WarpedVRT(pan_src, crs=grid.crs, transform=grid.transform, width=grid.width, height=grid.height,
+                           resampling=Resampling.average) as pan_low:
+                for row in range(0, grid.height, chunk_rows):
+                    window = Window(0, row, grid.width, min(chunk_rows, grid.height - row))
+                    ms = np.stack([src.read(1, window=window) for src in ms_sources])
+                    accumulator.update_reduced(ms, pan_low.read(1, window=window))
+        finally:
+            for src in ms_sources:
+                src.close()
+    return accumulator.result()
@@ -0,0 +1,145 @@
+"""
+Quick-look previews: a scene is pansharpened at a fraction of its resolution and rendered as an RGB thumbnail.
+
+MS and PAN are read decimated by the same factor, so their resolution ratio (and therefore the fused pipelines) is
+unchanged. GDAL serves a decimated read from the closest internal/external overview when the file has some, and
+otherwise decodes the band once; nearest resampling turns it into a plain strided read.
+
+The Gram-Schmidt parameters are not estimated on the decimated images, whose PAN has lost its high frequencies,
+but on full-resolution patches spread over the scene and read exactly as the tiled engine reads its tiles. The
+preview thus applies (a sampled estimate of) the injection of the full-resolution run, and since the injection is
+affine per pixel, an averaged preview approximates the full-resolution product averaged down to the same scale.
+"""
+import logging
+import math
+import cv2
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from .gram_schmidt import apply_gs_injection, gs_parameters_from_moments
+from .high_pass import pansharpen_hpf_fused
+from .statistics import JointMoments
+from .tiling import open_aligned_bands, read_tile
+from .upsampling import bilinear_grid, upsample_rows
+
+logger = logging.getLogger(__name__)
+
+def read_decimated(filepath, factor, resampling=Resampling.average):
+    """
+    Reads band 1 of a raster decimated by factor (the output size is rounded up, the extent is kept).
+    Args:
+        filepath (str): Path of the raster.
+        factor (int): Decimation factor.
+        resampling (Resampling): average (box filter, or the overviews) or nearest (strided read).
+    Returns:
+        tuple: (band array, metadata with the width, height and transform of the decimated grid)
+    """
+    with rasterio.open(filepath) as src:
+        height, width = src.height, src.width
+        shape = (math.ceil(height / factor), math.ceil(width / factor))
+        band = src.read(1, out_shape=shape, resampling=resampling)
+        meta = src.meta.copy()
+    meta.update(width=shape[1], height=shape[0],
+                transform=meta['transform'] * Affine.scale(width / shape[1], height / shape[0]))
+    return band, meta
+
+def read_preview(ms_paths, pan_path, factor, resampling=Resampling.average):
+    """
+    Reads the MS bands and the PAN band, each decimated by factor.
+    Returns:
+        tuple: (MS stack (bands, h, w) on its decimated grid, its metadata, PAN (H, W), its metadata)
+    """
+    ms_list, ms_meta_list = zip(*(read_decimated(path, factor, resampling) for path in ms_paths))
+    pan, pan_meta = read_decimated(pan_path, factor, resampling)
+    logger.info("Preview at 1/%d: MS %s, PAN %s", factor, ms_list[0].shape, pan.shape)
+    return np.stack(ms_list), ms_meta_list[0], pan, pan_meta
+
+def upsample_preview(ms, ms_meta, pan_meta):
+    """Bilinear upsampling of a decimated MS stack to the decimated PAN grid (see bilinear_grid), in float32."""
+    grid = bilinear_grid(ms.shape[1:], (pan_meta['height'], pan_meta['width']), ms_meta['transform'], pan_meta['transform'])
+    return upsample_rows(ms, grid, 0, pan_meta['height'])
+
+def patch_offsets(size, patches, patch_size):
+    """Offsets of `patches` patches centred on a regular grid along an axis, or of a tiling if they would overlap."""
+    if patches * patch_size >= size:
+        return range(0, size, patch_size)
+    step = size / patches
+    return [int((i + 0.5) * step - patch_size / 2) for i in range(patches)]
+
+def sampled_gs_moments(ms_paths, pan_path, patches=8, patch_size=256):
+    """
+    Joint moments of the MS bands (on the PAN grid) and the PAN band over patches x patches full-resolution patches
+    spread evenly over the scene, read like the tiles of pansharpen_gs_tiled. Scenes smaller than the patch grid are
+    covered entirely, which gives the exact full-resolution moments.
+    Returns:
+        JointMoments: Moments over [MS bands..., PAN].
+    """
+    with open_aligned_bands(ms_paths, pan_path) as (ms_sources, pan_src):
+        height, width = pan_src.height, pan_src.width
+        moments = JointMoments(len(ms_sources) + 1)
+        for row in patch_offsets(height, patches, patch_size):
+            for col in patch_offsets(width, patches, patch_size):
+                window = Window(col, row, min(patch_size, width - col), min(patch_size, height - row))
+                ms_tile, pan_tile = read_tile(ms_sources, pan_src, window)
+                moments.update(np.concatenate([ms_tile, pan_tile[np.newaxis]]))
+    logger.info("GS statistics from %d full-resolution pixels (%.2f%% of the scene)", moments.count,
+                100 * moments.count / (height * width))
+    return moments
+
+def preview_gs(ms_paths, pan_path, factor, resampling=Resampling.average, weights=None, patches=8, patch_size=256,
+               backend='numpy'):
+    """
+    Gram-Schmidt preview: the injection parameters come from full-resolution patches (sampled_gs_moments) and are
+    applied to the MS and PAN bands decimated by factor.
+    Returns:
+        numpy.ndarray: Sharpened preview (bands, H / factor, W / factor) in float32.
+    """
+    moments = sampled_gs_moments(ms_paths, pan_path, patches, patch_size)
+    params = gs_parameters_from_moments(moments.mean, moments.covariance, weights)
+    logger.info("Weights used for synthetic panchromatic image: %s", params['weights'])
+    ms, ms_meta, pan, pan_meta = read_preview(ms_paths, pan_path, factor, resampling)
+    ms_up = upsample_preview(ms, ms_meta, pan_meta)
+    return apply_gs_injection(ms_up, pan, params, out=ms_up, backend=backend)
+
+def preview_hpf(ms_paths, pan_path, factor, resampling=Resampling.average, kernel_size=5, sigma=1.0):
+    """
+    High Pass Filtering preview (the method has no scene statistics): the high frequencies of the decimated PAN
+    are added to the decimated MS bands, i.e. the details are those visible at the preview scale.
+    Returns:
+        numpy.ndarray: Sharpened preview (bands, H / factor, W / factor) in float32.
+    """
+    ms, ms_meta, pan, pan_meta = read_preview(ms_paths, pan_path, factor, resampling)
+    return pansharpen_hpf_fused(ms, pan, ms_meta['transform'], pan_meta['transform'], kernel_size, sigma)
+
+def rgb_thumbnail(image, bands=(2, 1, 0), percentiles=(2, 98)):
+    """
+    8-bit RGB rendering of a (bands, h, w) image, each channel linearly stretched between two percentiles.
+    Zero pixels (outside the scene footprint) are left out of the percentiles.
+    Args:
+        image (numpy.ndarray): Image of shape (bands, h, w).
+        bands (tuple): Indices of the red, green and blue bands (default: B4, B3, B2 in ms_band_paths order).
+        percentiles (tuple): Low and high percentiles mapped to 0 and 255.
+    Returns:
+        numpy.ndarray: Array of shape (h, w, 3) in uint8.
+    """
+    rgb = np.empty(image.shape[1:] + (3,), dtype=np.uint8)
+    for i, band in enumerate(bands):
+        values = image[band]
+        valid = values[values > 0]
+        low, high = np.percentile(valid if valid.size else values, percentiles)
+        scale = 255 / (high - low) if high > low else 0.0
+        rgb[..., i] = np.clip((values - low) * scale, 0, 255)
+    return rgb
+
+def write_thumbnail(filepath, image, **kwargs):
+    """
+    Writes the RGB rendering of a (bands, h, w) image (see rgb_thumbnail for the keyword arguments) to a PNG or
+    JPEG file, depending on the extension.
+    """
+    rgb = rgb_thumbnail(image, **kwargs)
+    if not cv2.imwrite(filepath, np.ascontiguousarray(rgb[..., ::-1])): # OpenCV expects BGR
+        raise OSError(f"Could not write {filepath}")
+    logger.info("Thumbnail written to %s (%dx%d)", filepath, rgb.shape[1], rgb.shape[0])
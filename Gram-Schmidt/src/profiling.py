@@ -0,0 +1,131 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+def rss_high_water_mark():
+    """Peak resident set size of the process in bytes (VmHWM, or ru_maxrss where /proc is not available)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on Linux
+
+def reset_rss_high_water_mark():
+    """Resets the peak RSS to the current RSS (Linux only), so that the peak of each stage can be measured."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class _Frame:
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.traced_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.traced_peak = self.traced_start
+        self.rss_peak = 0
+
+class Profiler:
+    """
+    Opt-in per-stage instrumentation: wall time, CPU time, peak RSS and peak bytes allocated (tracemalloc, which
+    numpy reports its buffers to) of each stage, collected into a JSON report.
+
+    Stages are delimited with the `stage` context manager or the `profiled` decorator and may be nested. When the
+    profiler is disabled both are no-ops, so instrumented code costs nothing in normal runs. Peaks are measured by
+    resetting the high-water marks when a stage starts and folding them into every enclosing stage, so nested
+    stages do not hide each other's peaks.
+    """
+
+    def __init__(self, enabled=False, trace_allocations=True):
+        self.enabled = False
+        self.trace_allocations = trace_allocations
+        self.stages = []
+        self._stack = []
+        self._started = time.perf_counter()
+        if enabled:
+            self.enable()
+
+    def enable(self, trace_allocations=None):
+        if trace_allocations is not None:
+            self.trace_allocations = trace_allocations
+        self.enabled = True
+        self._started = time.perf_counter()
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _fold_peaks(self):
+        """Propagates the current high-water marks to the open stages and resets them."""
+        traced_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+        rss_peak = rss_high_water_mark()
+        for frame in self._stack:
+            frame.traced_peak = max(frame.traced_peak, traced_peak)
+            frame.rss_peak = max(frame.rss_peak, rss_peak)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        reset_rss_high_water_mark()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Records the resources used by the enclosed block under `name`."""
+        if not self.enabled:
+            yield
+            return
+        self._fold_peaks()
+        frame = _Frame(name)
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._fold_peaks()
+            self._stack.pop()
+            record = {
+                'stage': '/'.join([f.name for f in self._stack] + [name]),
+                'wall_seconds': time.perf_counter() - frame.wall,
+                'cpu_seconds': time.process_time() - frame.cpu,
+                'peak_rss_mb': frame.rss_peak / 2**20,
+                'peak_allocated_mb': (frame.traced_peak - frame.traced_start) / 2**20 if self.trace_allocations else None,
+            }
+            self.stages.append(record)
+            logger.info("[profile] %s: %.3f s wall, %.3f s CPU, peak RSS %.1f MB", record['stage'],
+                        record['wall_seconds'], record['cpu_seconds'], record['peak_rss_mb'])
+
+    def profiled(self, name=None):
+        """Decorator recording every call of the function as a stage (named after the function by default)."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self, **run_info):
+        """Report of the run: run information (any keyword arguments, e.g. the CLI arguments) and the stages in order of completion."""
+        return {
+            'run': dict(run_info, argv=sys.argv, python=platform.python_version(), pid=os.getpid(),
+                        cpu_count=os.cpu_count(), total_wall_seconds=time.perf_counter() - self._started),
+            'stages': self.stages,
+        }
+
+    def write_report(self, path, **run_info):
+        with open(path, 'w') as f:
+            json.dump(self.report(**run_info), f, indent=2, default=str)
+        logger.info("Profile written to %s", path)
+
+# Shared instance used by the scripts: `with PROFILER.stage("load_bands"): ...`, enabled from the command line
+PROFILER = Profiler()
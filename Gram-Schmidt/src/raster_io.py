@@ -0,0 +1,202 @@
+"""
+Windowed GeoTIFF reading and writing.
+
+Bands are decoded strip by strip along their internal blocks, optionally only over a region of interest given in
+map coordinates, optionally from an overview level, and several bands are read at the same time (each from its
+own dataset handle, GDAL releases the GIL while decoding).
+
+Outputs are written as tiled, compressed GeoTIFFs on the grid of the reference band, window by window as the
+processing engines produce them, then given internal overviews and a cloud-optimised (COG) layout.
+"""
+import contextlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copy_dataset
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import bounds as window_bounds, transform as window_transform
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 256 # side of the internal tiles of the outputs; the engines write whole blocks
+
+def overview_levels(filepath):
+    """Decimation factors of the internal/external overviews of the first band (e.g. [2, 4, 8]), empty if none."""
+    with rasterio.open(filepath) as src:
+        return src.overviews(1)
+
+def open_band(filepath, overview_level=None):
+    """Opens a raster, or its overview number overview_level (0 is the first overview, i.e. factor overview_levels()[0])."""
+    if overview_level is None:
+        return rasterio.open(filepath)
+    return rasterio.open(filepath, overview_level=overview_level)
+
+def aligned_bounds(bounds, transform):
+    """
+    Snaps a bounding box outwards to the pixel edges of the grid `transform`.
+    Snapping the ROI to the coarsest grid (the MS bands) makes it cover whole pixels on the finer grids sharing
+    its origin (PAN), so the MS and PAN windows describe exactly the same ground area.
+    Args:
+        bounds (tuple): (left, bottom, right, top) in the CRS of the grid.
+        transform (Affine): North-up grid transform.
+    Returns:
+        tuple: Snapped (left, bottom, right, top).
+    """
+    left, bottom, right, top = bounds
+    col0, row0 = ~transform * (left, top)
+    col1, row1 = ~transform * (right, bottom)
+    eps = 1e-6 # tolerate bounds computed in floating point from the same grid
+    first_col, last_col = math.floor(min(col0, col1) + eps), math.ceil(max(col0, col1) - eps)
+    first_row, last_row = math.floor(min(row0, row1) + eps), math.ceil(max(row0, row1) - eps)
+    return window_bounds(Window(first_col, first_row, last_col - first_col, last_row - first_row), transform)
+
+def bounds_window(src, bounds):
+    """
+    Pixel window of an open dataset covering `bounds` (map coordinates), clipped to the raster.
+    Raises:
+        ValueError: If the bounds do not intersect the raster.
+    """
+    window = from_bounds(*bounds, transform=src.transform)
+    col0, row0 = round(window.col_off), round(window.row_off)
+    col1, row1 = round(window.col_off + window.width), round(window.row_off + window.height)
+    col0, row0, col1, row1 = max(col0, 0), max(row0, 0), min(col1, src.width), min(row1, src.height)
+    if col1 <= col0 or row1 <= row0:
+        raise ValueError(f"Bounds {bounds} do not intersect {src.name}")
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+def block_strips(src, window=None, min_rows=256):
+    """
+    Yields windows that cover `window` (the whole raster by default) in strips of whole block rows of band 1,
+    at least min_rows tall, so that every internal block is decoded once and blocks outside the window never are.
+    """
+    if window is None:
+        window = Window(0, 0, src.width, src.height)
+    block_rows = src.block_shapes[0][0]
+    rows = max(block_rows, min_rows // block_rows * block_rows)
+    top, bottom = int(window.row_off), int(window.row_off + window.height)
+    row = top
+    while row < bottom:
+        end = min((row // block_rows) * block_rows + rows, bottom) # realign to block boundaries after the first strip
+        yield Window(window.col_off, row, window.width, end - row)
+        row = end
+
+def read_window(filepath, bounds=None, overview_level=None, out=None):
+    """
+    Reads band 1 of a raster, optionally only the region `bounds` and/or from an overview level.
+    Args:
+        filepath (str): Path of the raster.
+        bounds (tuple): Optional (left, bottom, right, top) in the raster CRS, see aligned_bounds.
+        overview_level (int): Optional overview to read instead of the full resolution.
+        out (numpy.ndarray): Optional array of the window shape to read into.
+    Returns:
+        tuple: (band array, metadata with the width, height and transform of the window read)
+    """
+    with open_band(filepath, overview_level) as src:
+        window = bounds_window(src, bounds) if bounds is not None else Window(0, 0, src.width, src.height)
+        logger.debug("Reading %s (overview %s), window %s", filepath, overview_level, window)
+        shape = (int(window.height), int(window.width))
+        band = np.empty(shape, dtype=src.dtypes[0]) if out is None else out
+        top = int(window.row_off)
+        for strip in block_strips(src, window):
+            row = int(strip.row_off) - top
+            src.read(1, window=strip, out=band[row:row + int(strip.height)])
+        meta = src.meta.copy()
+    meta.update(width=shape[1], height=shape[0], transform=window_transform(window, meta['transform']))
+    return band, meta
+
+def read_bands(filepaths, bounds=None, overview_level=None, workers=None):
+    """
+    Reads band 1 of several rasters concurrently (see read_window for the arguments).
+    Args:
+        workers (int): Number of rasters read at the same time (default: one per raster, capped by the CPU count).
+    Returns:
+        tuple: (list of band arrays, list of metadata), in the order of filepaths.
+    """
+    workers = workers or min(len(filepaths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda path: read_window(path, bounds, overview_level), filepaths))
+    return [band for band, _ in results], [meta for _, meta in results]
+
+def output_profile(meta, count, dtype='float32', block_size=BLOCK_SIZE):
+    """
+    Builds the rasterio profile of a tiled, compressed GeoTIFF on the grid described by meta.
+    Args:
+        meta (dict): Metadata of the reference band (usually the panchromatic band).
+        count (int): Number of bands to write.
+        dtype (str): Output data type.
+        block_size (int): Internal tile size (multiple of 16).
+    Returns:
+        dict: Profile to pass to rasterio.open(..., 'w', **profile).
+    """
+    return {
+        'driver': 'GTiff', 'height': meta['height'], 'width': meta['width'], 'count': count, 'dtype': dtype,
+        'crs': meta['crs'], 'transform': meta['transform'], 'nodata': None,
+        'tiled': True, 'blockxsize': block_size, 'blockysize': block_size,
+        'compress': 'deflate', 'predictor': 3 if np.dtype(dtype).kind == 'f' else 2, 'BIGTIFF': 'IF_SAFER',
+    }
+
+def overview_factors(height, width, block_size=BLOCK_SIZE):
+    """Decimation factors 2, 4, 8... until the overview fits in a single block (none for small rasters)."""
+    factors = []
+    factor = 2
+    while max(height, width) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+@contextlib.contextmanager
+def open_output(filepath, meta, count, dtype='float32', block_size=BLOCK_SIZE, overviews=True, cog=True,
+                resampling=Resampling.average):
+    """
+    Opens a tiled, compressed GeoTIFF for writing on the grid described by meta (see output_profile).
+    Blocks are written with dst.write(block, window=window) as soon as they are ready; when the block closes, the
+    overviews are built from the written tiles and the file is rewritten with the COG layout (overviews and tiles
+    ordered for range requests), a sequential disk-to-disk copy that never holds the image in memory.
+    Args:
+        filepath (str): Output path.
+        meta (dict): Metadata of the reference band (usually the panchromatic band).
+        count (int): Number of bands to write.
+        dtype (str): Output data type.
+        block_size (int): Internal tile size (multiple of 16).
+        overviews (bool): Build internal overviews (factors from overview_factors).
+        cog (bool): Rewrite the result with the cloud-optimised layout.
+        resampling (Resampling): Resampling of the overviews.
+    Yields:
+        rasterio dataset open in write mode.
+    """
+    profile = output_profile(meta, count, dtype, block_size)
+    path = f"{filepath}.{os.getpid()}.tmp.tif" if cog else filepath
+    try:
+        with rasterio.open(path, 'w', **profile) as dst:
+            yield dst
+            factors = overview_factors(dst.height, dst.width, block_size) if overviews else []
+            if factors:
+                logger.info("Building overviews %s of %s", factors, filepath)
+                dst.build_overviews(factors, resampling)
+        if cog:
+            logger.info("Writing cloud-optimised GeoTIFF %s", filepath)
+            copy_dataset(path, filepath, driver='COG', COMPRESS='DEFLATE', PREDICTOR='YES', BLOCKSIZE=block_size,
+                         BIGTIFF='IF_SAFER', OVERVIEWS='FORCE_USE_EXISTING' if factors else 'NONE')
+    finally:
+        if cog and os.path.exists(path):
+            os.remove(path)
+
+def write_bands(filepath, bands, meta, block_size=BLOCK_SIZE, **kwargs):
+    """
+    Writes a (bands, H, W) array to a cloud-optimised GeoTIFF on the grid described by meta, in strips of
+    block rows (so memmaps are paged through rather than loaded). Extra keyword arguments go to open_output.
+    Args:
+        filepath (str): Output path.
+        bands (numpy.ndarray): Array of shape (bands, H, W).
+        meta (dict): Metadata of the reference band (usually the panchromatic band).
+    """
+    logger.info("Writing %s", filepath)
+    height, width = bands.shape[1:]
+    with open_output(filepath, meta, bands.shape[0], bands.dtype.name, block_size, **kwargs) as dst:
+        for row in range(0, height, block_size):
+            rows = min(block_size, height - row)
+            dst.write(bands[:, row:row + rows], window=Window(0, row, width, rows))
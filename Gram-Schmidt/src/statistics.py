@@ -0,0 +1,165 @@
+import numpy as np
+
+
+class JointMoments:
+    """
+    Streaming means and covariance matrix of a stack of variables (e.g. the MS bands and the PAN band).
+
+    Blocks of pixels are folded in one at a time with `update`, and partial results computed on
+    different tiles or processes can be combined with `merge`. Each block is centred on its own mean
+    before being merged (pairwise update of Chan et al.), so the result does not suffer from the
+    cancellation of the naive E[x^2] - E[x]^2 formula on large scenes.
+    """
+
+    def __init__(self, n_vars):
+        self.n_vars = n_vars
+        self.count = 0
+        self.mean = np.zeros(n_vars, dtype=np.float64)
+        self.m2 = np.zeros((n_vars, n_vars), dtype=np.float64) # sum of outer products of deviations
+
+    def update(self, block):
+        """
+        Adds a block of samples.
+        Args:
+            block (numpy.ndarray): Array of shape (n_vars, ...) holding one block per variable.
+        """
+        samples = block.reshape(self.n_vars, -1)
+        count = samples.shape[1]
+        if count == 0:
+            return self
+        mean = samples.mean(axis=1, dtype=np.float64)
+        centered = samples - mean[:, None]
+        self._combine(count, mean, centered @ centered.T)
+        return self
+
+    def merge(self, other):
+        """Merges the moments accumulated by another JointMoments over disjoint samples."""
+        if other.n_vars != self.n_vars:
+            raise ValueError("Cannot merge moments over a different number of variables.")
+        if other.count:
+            self._combine(other.count, other.mean, other.m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + np.outer(delta, delta) * (self.count * count / total)
+        self.mean += delta * (count / total)
+        self.count = total
+
+    @property
+    def covariance(self):
+        """Population covariance matrix (normalised by the number of samples, like np.mean/np.std)."""
+        if self.count == 0:
+            raise ValueError("No samples accumulated.")
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        """Population standard deviation of each variable."""
+        return np.sqrt(np.diag(self.covariance))
+
+    @property
+    def correlation(self):
+        """Pearson correlation matrix (zero where a variable is constant)."""
+        std = self.std
+        denom = np.outer(std, std)
+        return np.divide(self.covariance, denom, out=np.zeros_like(denom), where=denom > 0)
+
+
+def gs_moments(ms, pan, chunk_rows=512):
+    """
+    Joint moments of the MS bands and the PAN band in a single vectorised pass over the data.
+    Args:
+        ms (numpy.ndarray): MS bands at PAN resolution [nb_bands, h, w].
+        pan (numpy.ndarray): Panchromatic band [h, w].
+        chunk_rows (int): Number of image rows per chunk; None processes the whole image at once.
+                          Chunking bounds the float64 temporaries to the chunk size.
+    Returns:
+        JointMoments: Moments over [MS bands..., PAN].
+    """
+    nb_bands, height = ms.shape[0], ms.shape[1]
+    chunk_rows = chunk_rows or height
+    moments = JointMoments(nb_bands + 1)
+    block = None
+    for row in range(0, height, chunk_rows):
+        rows = min(chunk_rows, height - row)
+        if block is None or block.shape[1] != rows:
+            block = np.empty((nb_bands + 1, rows, ms.shape[2]), dtype=np.float32)
+        block[:nb_bands] = ms[:, row:row + rows]
+        block[nb_bands] = pan[row:row + rows]
+        moments.update(block)
+    return moments
+
+
+class BandHistograms:
+    """
+    Per-band histograms on a fixed grid of bins, accumulated block by block.
+
+    Integer images of at most 16 bits get one bin per possible value, so their histograms are exact; other
+    images (floats) are quantised on `bins` equal bins spanning `value_range`, which must then be known
+    beforehand (e.g. from a min/max pass) so that histograms of different tiles share the same grid and can
+    be merged. Counting is a single np.bincount per band, no sort.
+    """
+
+    def __init__(self, n_bands, dtype, value_range=None, bins=4096):
+        dtype = np.dtype(dtype)
+        self.n_bands = n_bands
+        self.exact = dtype.kind in 'iub' and dtype.itemsize <= 2
+        if self.exact:
+            info = np.iinfo(dtype) if dtype.kind != 'b' else np.iinfo(np.uint8)
+            self.lo, self.bins, self.width = int(info.min), int(info.max) - int(info.min) + 1, 1.0
+        else:
+            if value_range is None:
+                raise ValueError("value_range is required to quantise non-integer images.")
+            lo, hi = float(value_range[0]), float(value_range[1])
+            self.lo, self.bins = lo, bins
+            self.width = (hi - lo) / bins if hi > lo else 1.0
+        self.counts = np.zeros((n_bands, self.bins), dtype=np.int64)
+
+    @classmethod
+    def from_image(cls, image, bins=4096):
+        """Histograms of a whole (bands, h, w) image, on a grid spanning its own value range for floats."""
+        value_range = None
+        if not (image.dtype.kind in 'iub' and image.dtype.itemsize <= 2):
+            value_range = (image.min(), image.max())
+        return cls(image.shape[0], image.dtype, value_range, bins).update(image)
+
+    def bin_index(self, band):
+        """Index of the bin holding each pixel of a 2D band (values outside the grid go to the edge bins)."""
+        if self.exact:
+            return band.astype(np.intp) - self.lo if self.lo else band.astype(np.intp)
+        index = (band - self.lo) * (1.0 / self.width)
+        np.clip(index, 0, self.bins - 1, out=index)
+        return index.astype(np.intp)
+
+    def update(self, block):
+        """
+        Adds a block of pixels.
+        Args:
+            block (numpy.ndarray): Array of shape (n_bands, ...).
+        """
+        for i in range(self.n_bands):
+            self.counts[i] += np.bincount(self.bin_index(block[i]).ravel(), minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        """Merges the histograms accumulated by another BandHistograms on the same grid."""
+        if (other.n_bands, other.lo, other.bins, other.width) != (self.n_bands, self.lo, self.bins, self.width):
+            raise ValueError("Cannot merge histograms computed on different grids.")
+        self.counts += other.counts
+        return self
+
+    @property
+    def centers(self):
+        """Value represented by each bin (the integer value itself for exact histograms)."""
+        offset = 0.0 if self.exact else 0.5
+        return self.lo + (np.arange(self.bins) + offset) * self.width
+
+    @property
+    def cdf(self):
+        """Mid-rank cumulative distribution of each band at every bin, in [0, 1], shape (n_bands, bins)."""
+        totals = self.counts.sum(axis=1, keepdims=True)
+        if not totals.all():
+            raise ValueError("No samples accumulated.")
+        return (np.cumsum(self.counts, axis=1) - 0.5 * self.counts) / totals
@@ -0,0 +1,103 @@
+import contextlib
+import logging
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from .raster_io import BLOCK_SIZE, open_output
+from .gram_schmidt import gs_parameters_from_moments, apply_gs_injection
+from .statistics import JointMoments
+
+logger = logging.getLogger(__name__)
+
+def iter_windows(height, width, tile_size):
+    """Yields rasterio windows covering a (height, width) grid in row-major tiles of tile_size pixels."""
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+@contextlib.contextmanager
+def open_aligned_bands(ms_paths, pan_path):
+    """
+    Opens the PAN band and the MS bands so that every MS band can be read on the PAN grid.
+    MS bands that do not already share the PAN grid are wrapped in a bilinear WarpedVRT, so that a
+    window read returns the resampled pixels without ever resampling the full band.
+    Args:
+        ms_paths (list): Paths of the multispectral bands.
+        pan_path (str): Path of the panchromatic band.
+    Yields:
+        tuple: (list of MS datasets on the PAN grid, PAN dataset)
+    """
+    with contextlib.ExitStack() as stack:
+        pan_src = stack.enter_context(rasterio.open(pan_path))
+        ms_sources = []
+        for path in ms_paths:
+            src = stack.enter_context(rasterio.open(path))
+            if src.shape != pan_src.shape or src.transform != pan_src.transform or src.crs != pan_src.crs:
+                src = stack.enter_context(WarpedVRT(src, crs=pan_src.crs, transform=pan_src.transform,
+                                                    width=pan_src.width, height=pan_src.height,
+                                                    resampling=Resampling.bilinear))
+            ms_sources.append(src)
+        yield ms_sources, pan_src
+
+def read_tile(ms_sources, pan_src, window):
+    """
+    Reads one window of the MS bands and the PAN band as float32.
+    Returns:
+        tuple: (MS tile of shape (bands, h, w), PAN tile of shape (h, w))
+    """
+    ms_tile = np.empty((len(ms_sources), int(window.height), int(window.width)), dtype=np.float32)
+    for i, src in enumerate(ms_sources):
+        ms_tile[i] = src.read(1, window=window)
+    pan_tile = pan_src.read(1, window=window).astype(np.float32)
+    return ms_tile, pan_tile
+
+def windowed_gs_moments(ms_sources, pan_src, tile_size=1024):
+    """
+    First streaming pass: accumulates the joint means and covariances of the MS bands and PAN tile by tile.
+    Returns:
+        JointMoments: Moments over [MS bands..., PAN].
+    """
+    moments = JointMoments(len(ms_sources) + 1)
+    for window in iter_windows(pan_src.height, pan_src.width, tile_size):
+        ms_tile, pan_tile = read_tile(ms_sources, pan_src, window)
+        moments.update(np.concatenate([ms_tile, pan_tile[np.newaxis]]))
+    return moments
+
+def pansharpen_gs_tiled(ms_paths, pan_path, output_path, tile_size=1024, weights=None, backend='numpy', overviews=True, cog=True):
+    """
+    Gram-Schmidt pansharpening of a full scene with memory bounded by the tile size.
+
+    The scene statistics (weights, means, stds and covariances) are computed in a first streaming pass,
+    then the GS injection is applied tile by tile and each tile is written straight to a tiled GeoTIFF.
+    Args:
+        ms_paths (list): Paths of the multispectral bands (any resolution, resampled on the fly).
+        pan_path (str): Path of the panchromatic band, which defines the output grid.
+        output_path (str): Path of the float32 GeoTIFF to write, one band per MS band.
+        tile_size (int): Side of the processing tiles in PAN pixels (multiple of the 256-pixel output blocks).
+        weights: Optional weights for the synthetic pan (see pansharpen_gs).
+        backend (str): Injection backend, see apply_gs_injection.
+        overviews, cog (bool): Build internal overviews and write the cloud-optimised layout (see open_output).
+    Returns:
+        dict: The Gram-Schmidt parameters used for the whole scene.
+    """
+    if tile_size % BLOCK_SIZE != 0:
+        raise ValueError(f"tile_size must be a multiple of {BLOCK_SIZE} (GeoTIFF block size).")
+
+    with open_aligned_bands(ms_paths, pan_path) as (ms_sources, pan_src):
+        logger.info("Computing scene statistics over %dx%d pixels in tiles of %d...", pan_src.height, pan_src.width, tile_size)
+        moments = windowed_gs_moments(ms_sources, pan_src, tile_size)
+        params = gs_parameters_from_moments(moments.mean, moments.covariance, weights)
+        logger.info("Weights used for synthetic panchromatic image: %s", params['weights'])
+        logger.info("Gains: %s", params['gains'])
+
+        logger.info("Applying Gram-Schmidt injection tile by tile, writing to %s...", output_path)
+        with open_output(output_path, pan_src.meta, len(ms_sources), 'float32', overviews=overviews, cog=cog) as dst:
+            for window in iter_windows(pan_src.height, pan_src.width, tile_size):
+                ms_tile, pan_tile = read_tile(ms_sources, pan_src, window)
+                dst.write(apply_gs_injection(ms_tile, pan_tile, params, out=ms_tile, backend=backend), window=window)
+
+    logger.info("Tiled pansharpening completed.")
+    return params
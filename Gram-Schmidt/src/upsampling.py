@@ -0,0 +1,87 @@
+import numpy as np
+
+def axis_taps(dst_size, src_size, scale=None, offset=None):
+    """
+    Bilinear taps along one axis: destination pixel i samples the source at coordinate i * scale + offset
+    (pixel centres), clamped to the source, between pixels i0[i] and i1[i] with weight frac[i] on i1.
+    Args:
+        dst_size (int): Number of destination pixels.
+        src_size (int): Number of source pixels.
+        scale (float): Source pixels per destination pixel (default: src_size / dst_size, same extent).
+        offset (float): Source coordinate of the first destination pixel centre (default: same extent).
+    Returns:
+        tuple: (i0, i1, frac) arrays of length dst_size.
+    """
+    if scale is None:
+        scale = src_size / dst_size
+        offset = 0.5 * scale - 0.5
+    coords = np.clip(np.arange(dst_size) * scale + offset, 0, src_size - 1)
+    i0 = np.floor(coords).astype(np.intp)
+    i1 = np.minimum(i0 + 1, src_size - 1)
+    return i0, i1, (coords - i0).astype(np.float32)
+
+def bilinear_grid(src_shape, dst_shape, src_transform=None, dst_transform=None):
+    """
+    Row and column taps of the bilinear upsampling from a source grid to a destination grid.
+    With both geotransforms (north-up, in the same CRS) the grids are aligned through their map coordinates, as
+    rasterio/GDAL bilinear resampling does; without them the two grids are assumed to cover the same extent.
+    Args:
+        src_shape (tuple): (height, width) of the source (MS) grid.
+        dst_shape (tuple): (height, width) of the destination (PAN) grid.
+        src_transform (Affine): Optional transform of the source grid.
+        dst_transform (Affine): Optional transform of the destination grid.
+    Returns:
+        dict: {'rows': (i0, i1, frac), 'cols': (i0, i1, frac)}
+    """
+    if src_transform is None or dst_transform is None:
+        return {'rows': axis_taps(dst_shape[0], src_shape[0]), 'cols': axis_taps(dst_shape[1], src_shape[1])}
+    if src_transform.b or src_transform.d or dst_transform.b or dst_transform.d:
+        raise ValueError("Fused upsampling needs north-up grids, use resample_ms_to_pan for rotated ones.")
+    col_scale = dst_transform.a / src_transform.a
+    row_scale = dst_transform.e / src_transform.e
+    return {
+        'rows': axis_taps(dst_shape[0], src_shape[0], row_scale,
+                          (dst_transform.f - src_transform.f) / src_transform.e + 0.5 * row_scale - 0.5),
+        'cols': axis_taps(dst_shape[1], src_shape[1], col_scale,
+                          (dst_transform.c - src_transform.c) / src_transform.a + 0.5 * col_scale - 0.5),
+    }
+
+def upsample_rows(ms, grid, row, rows, out=None):
+    """
+    Separable bilinear upsampling of the destination rows [row, row + rows) of every band: only the source rows
+    those rows depend on are interpolated horizontally, then blended vertically straight into `out`.
+    Args:
+        ms (numpy.ndarray): Source bands (bands, h, w), any numeric dtype.
+        grid (dict): Taps returned by bilinear_grid.
+        row (int): First destination row.
+        rows (int): Number of destination rows.
+        out (numpy.ndarray): Optional float32 array (bands, rows, W) to write into, e.g. a slice of the output.
+    Returns:
+        numpy.ndarray: Upsampled block (bands, rows, W) in float32.
+    """
+    r0, r1, row_frac = (taps[row:row + rows] for taps in grid['rows'])
+    c0, c1, col_frac = grid['cols']
+    if out is None:
+        out = np.empty((ms.shape[0], rows, len(c0)), dtype=np.float32)
+    first, last = r0[0], r1[-1] + 1
+    r0, r1 = r0 - first, r1 - first
+    row_frac = row_frac[:, np.newaxis]
+
+    left = np.empty((last - first, len(c0)), dtype=np.float32)
+    right = np.empty_like(left)
+    lower = np.empty((rows, len(c0)), dtype=np.float32)
+    for i in range(ms.shape[0]):
+        src = ms[i, first:last].astype(np.float32, copy=False)
+        # horizontal pass over the source rows needed by the block
+        np.take(src, c0, axis=1, out=left, mode='clip')
+        np.take(src, c1, axis=1, out=right, mode='clip')
+        right -= left
+        right *= col_frac
+        left += right
+        # vertical pass, written directly to the output
+        np.take(left, r0, axis=0, out=out[i], mode='clip')
+        np.take(left, r1, axis=0, out=lower, mode='clip')
+        lower -= out[i]
+        lower *= row_frac
+        out[i] += lower
+    return out
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts run from Gram-Schmidt/ and import the package as `src`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
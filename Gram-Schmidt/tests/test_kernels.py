@@ -0,0 +1,89 @@
+"""
+Parity of the optional Numba kernels (src/kernels.py) with the NumPy reference implementation.
+The Gram-Schmidt injection performs the same float32 operations in the same order, so its results must be
+bit-identical; the spectral angles only agree to within the accuracy of a float32 arccos near zero.
+"""
+import numpy as np
+import pytest
+
+from src.gram_schmidt import pansharpen_gs, pansharpen_gs_fused
+from src.kernels import HAVE_NUMBA, resolve_backend
+from src.metrics import compute_metrics, spectral_angle_map
+from src.upsampling import bilinear_grid, upsample_rows
+
+requires_numba = pytest.mark.skipif(not HAVE_NUMBA, reason="Numba is not installed")
+
+# near 0, arccos of a float32 cosine is only accurate to about sqrt(float32 eps) ~ 3e-4 rad
+SAM_TOLERANCE = 2e-3
+
+@pytest.fixture(scope="module")
+def scene():
+    """uint16 MS bands at half the PAN resolution, correlated with the PAN, and their bilinear upsampling."""
+    rng = np.random.default_rng(0)
+    pan = rng.normal(8000, 1500, (256, 256)).clip(1, 65535)
+    pan_low = pan.reshape(128, 2, 128, 2).mean(axis=(1, 3))
+    ms = np.stack([pan_low * gain + rng.normal(0, 300, pan_low.shape) for gain in (0.6, 0.8, 1.0, 1.2)])
+    ms = ms.clip(0, 65535).astype(np.uint16)
+    pan = pan.astype(np.uint16)
+    ms_up = upsample_rows(ms, bilinear_grid(ms.shape[1:], pan.shape), 0, pan.shape[0])
+    return ms, pan, ms_up
+
+@requires_numba
+def test_gs_float32_bit_identical(scene):
+    _, pan, ms_up = scene
+    np.testing.assert_array_equal(pansharpen_gs(ms_up, pan, backend='numba'), pansharpen_gs(ms_up, pan))
+
+@requires_numba
+def test_gs_uint16_bit_identical(scene):
+    _, pan, ms_up = scene
+    ms_up_int = np.rint(ms_up).astype(np.uint16)
+    np.testing.assert_array_equal(pansharpen_gs(ms_up_int, pan, backend='numba'), pansharpen_gs(ms_up_int, pan))
+
+@requires_numba
+def test_gs_in_place_bit_identical(scene):
+    _, pan, ms_up = scene
+    expected = pansharpen_gs(ms_up, pan)
+    in_place = ms_up.copy()
+    result = pansharpen_gs(in_place, pan, out=in_place, backend='numba')
+    assert result is in_place
+    np.testing.assert_array_equal(in_place, expected)
+
+@requires_numba
+def test_gs_fused_bit_identical(scene):
+    ms, pan, _ = scene
+    np.testing.assert_array_equal(pansharpen_gs_fused(ms, pan, block_rows=64, backend='numba'),
+                                  pansharpen_gs_fused(ms, pan, block_rows=64))
+
+@requires_numba
+@pytest.mark.parametrize("layout", ['chw', 'hwc'])
+def test_spectral_angle_map_within_tolerance(scene, layout):
+    _, pan, ms_up = scene
+    sharpened = pansharpen_gs(ms_up, pan)
+    reference, test = ms_up, sharpened
+    if layout == 'hwc':
+        reference, test = (np.ascontiguousarray(image.transpose(1, 2, 0)) for image in (reference, test))
+    np.testing.assert_allclose(spectral_angle_map(reference, test, layout=layout, backend='numba'),
+                               spectral_angle_map(reference, test, layout=layout), rtol=0, atol=SAM_TOLERANCE)
+
+@requires_numba
+def test_spectral_angle_map_uint16_within_tolerance(scene):
+    _, _, ms_up = scene
+    ms_up_int = np.rint(ms_up).astype(np.uint16)
+    np.testing.assert_allclose(spectral_angle_map(ms_up_int, ms_up, backend='numba'),
+                               spectral_angle_map(ms_up_int, ms_up), rtol=0, atol=SAM_TOLERANCE)
+
+@requires_numba
+def test_mean_sam_within_tolerance(scene):
+    _, pan, ms_up = scene
+    sharpened = pansharpen_gs(ms_up, pan)
+    assert compute_metrics(ms_up, sharpened, backend='numba')['SAM (radians)'] == \
+        pytest.approx(compute_metrics(ms_up, sharpened)['SAM (radians)'], abs=1e-5)
+
+def test_resolve_backend():
+    assert resolve_backend('numpy') == 'numpy'
+    assert resolve_backend('auto') == ('numba' if HAVE_NUMBA else 'numpy')
+    with pytest.raises(ValueError):
+        resolve_backend('cuda')
+    if not HAVE_NUMBA:
+        with pytest.raises(ImportError):
+            resolve_backend('numba')